@@ -0,0 +1,21 @@
+"""
+Import set up shared by the benchmarks. The repository root goes on
+sys.path and, when PyV8 is not installed, the python engine is selected
+so the request pipeline can be measured without V8.
+
+    import benchenv
+    from dnlib import jsapi
+"""
+import os
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+
+sys.path.insert(0, os.path.join(BENCH_DIR, ".."))
+
+from dnlib import jsengine
+
+if jsengine.PyV8 is None:
+    jsengine.selectPython()
+
+ENGINE = jsengine.current().name
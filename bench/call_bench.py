@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+"""
+Per call overhead of running a route callback in a javascript process.
+
+  eval   the callback, its arguments and a new logger wrapper are stored in
+         the context globals and "var res = jscb(logger,req,jsargs);" is
+         evaluated, as JSHandler._jsexec used to do
+  call   JSHandler._jsexec as it is, the function is called directly with
+         the logger of the route cached in the process
+
+The callback itself does nothing so the difference is the dispatch cost.
+"""
+import os
+import sys
+import time
+import argparse
+
+# repository root on sys.path, python engine when PyV8 is missing
+import benchenv
+
+# jsapi pulls in the rest of dnlib in the same order dreadnought.py does
+from dnlib import jsapi
+from dnlib import jshandler
+from dnlib import jsengine
+
+
+JS_CALLBACK = "(function (logger, req, args) { return {data: 'ok'}; })"
+
+
+def noop(logger, req, args):
+    return {'data': 'ok'}
+
+
+def legacy_jsexec(jsh, req):
+    (jscb, jsargs, route_logger, options) = jshandler.JsCbLookup[req['ident']]
+    jsh.context.locals.jscb = jscb
+    jsh.context.locals.jsargs = jsargs
+    jsh.context.locals.logger = route_logger.getLogger()
+    jsh.context.locals.req = req
+    jsengine.current().eval(jsh.context, "var res = jscb(logger,req,jsargs);")
+    return dict(jsh.context.locals.res or {})
+
+
+def measure(func, jsh, req, iterations):
+    func(jsh, req)
+    start = time.time()
+    for i in range(iterations):
+        func(jsh, req)
+    return (time.time() - start) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=100000)
+    args = parser.parse_args()
+
+    jsh = jshandler.JSHandler(jsapi.HandlerAPI())
+    jsh.context.enter()
+    if jsengine.current().name == 'pyv8':
+        callback = jsengine.current().eval(jsh.context, JS_CALLBACK)
+    else:
+        callback = noop
+    ident = jshandler.AddJsCb('/bench', callback, {})
+    req = {'path': '/bench', 'method': 'GET', 'qs_params': {'a': '1'},
+        'post_data': {}, 'ident': ident}
+
+    before = measure(legacy_jsexec, jsh, req, args.iterations)
+    after = measure(lambda jsh, req: jsh._jsexec(req), jsh, req, args.iterations)
+    jsh.context.leave()
+
+    print "engine %s, %d calls" % (jsengine.current().name, args.iterations)
+    print "%-6s %10.2f us/call" % ('eval', before * 1e6)
+    print "%-6s %10.2f us/call" % ('call', after * 1e6)
+    print "speedup %.2fx" % (before / after)
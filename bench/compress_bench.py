@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+"""
+CPU cost of response compression against the bytes it saves.
+
+Typical payloads (JSON API responses of several sizes, an HTML page and
+an incompressible blob) are compressed at a few zlib levels. For each one
+the compressed size, the CPU time per MB of input and the cost of serving
+the same body again from the compressed body cache are reported.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dnlib import jscompress
+
+
+def json_payload(n):
+    return json.dumps([{
+        'id': i,
+        'name': 'customer %d' % i,
+        'email': 'user%d@example.com' % i,
+        'balance': round(random.random() * 10000, 2),
+        'tags': random.sample(['new', 'vip', 'eu', 'us', 'trial', 'churn'], 2)
+    } for i in range(n)])
+
+
+def html_payload(rows):
+    body = ''.join(['<tr><td class="id">%d</td><td class="name">row %d</td>'
+        '<td class="value">%f</td></tr>\n' % (i, i, random.random())
+        for i in range(rows)])
+    return '<html><head><title>report</title></head><body><table>\n' + \
+        body + '</table></body></html>'
+
+
+def payloads():
+    random.seed(1)
+    return [
+        ('json-1KB', json_payload(8)),
+        ('json-16KB', json_payload(128)),
+        ('json-256KB', json_payload(2048)),
+        ('html-64KB', html_payload(800)),
+        ('random-64KB', os.urandom(64 * 1024))
+    ]
+
+
+def measure(data, coding, level, iterations):
+    start = time.clock()
+    for i in range(iterations):
+        body = jscompress.compress(data, coding, level)
+    cpu = (time.clock() - start) / iterations
+    return (len(body), cpu)
+
+
+def measure_cached(data, coding, level, iterations):
+    c = jscompress.Compressor(min_size=0, level=level)
+    accept = coding
+    c.encode(data, accept)
+    start = time.clock()
+    for i in range(iterations):
+        c.encode(data, accept)
+    return (time.clock() - start) / iterations
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--coding", default="gzip", help="gzip (default) or deflate")
+    parser.add_argument("--levels", default="1,6,9")
+    args = parser.parse_args()
+
+    print "%-12s %5s %10s %10s %7s %10s %10s" % ('payload', 'level',
+        'bytes', 'saved', 'ratio', 'cpu ms/MB', 'cached us')
+    for (name, data) in payloads():
+        n = args.iterations
+        if len(data) > 100 * 1024:
+            n = max(5, n / 10)
+        for level in [int(l) for l in args.levels.split(',')]:
+            (size, cpu) = measure(data, args.coding, level, n)
+            cached = measure_cached(data, args.coding, level, n)
+            print "%-12s %5d %10d %10d %7.2f %10.2f %10.1f" % (name, level,
+                size, len(data) - size, float(size) / len(data),
+                cpu * 1000.0 * (1024 * 1024) / len(data), cached * 1e6)
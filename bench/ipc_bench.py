@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+"""
+Compare the parent/child transports used by the javascript process pool.
+
+A child process echoes every object it receives, the parent measures the
+round trip of request dicts carrying 1 KB, 64 KB and 4 MB of post_data
+and reports throughput and latency percentiles for each transport. The
+shared memory rings have the size the pool gives them unless --ring-size
+says otherwise, a message that does not fit goes through the pipe.
+"""
+import os
+import sys
+import time
+import argparse
+
+# repository root on sys.path, python engine when PyV8 is missing
+import benchenv
+
+# jsapi pulls in the rest of dnlib in the same order dreadnought.py does
+from dnlib import jsapi
+from dnlib import jshandler
+from dnlib import shmring
+
+
+Payloads = [
+    ('1KB', 1024),
+    ('64KB', 64 * 1024),
+    ('4MB', 4 * 1024 * 1024)
+]
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    k = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[k]
+
+
+def echo_child(req_chan, res_chan):
+    while True:
+        obj = req_chan.recv()
+        if obj is None:
+            break
+        res_chan.send(obj)
+
+
+def run_case(name, factory, size, iterations):
+    req_chan = factory()
+    res_chan = factory()
+
+    pid = os.fork()
+    if pid == 0:
+        try:
+            echo_child(req_chan, res_chan)
+        finally:
+            os._exit(0)
+
+    req = {
+        'path': '/bench',
+        'method': 'POST',
+        'qs_params': {},
+        'post_data': {'data': 'x' * size},
+        'ident': 0
+    }
+
+    # warm up
+    req_chan.send(req)
+    res_chan.recv()
+
+    samples = []
+    start = time.time()
+    for i in range(iterations):
+        t = time.time()
+        req_chan.send(req)
+        res_chan.recv()
+        samples.append(time.time() - t)
+    elapsed = time.time() - start
+
+    req_chan.send(None)
+    os.waitpid(pid, 0)
+
+    return {
+        'transport': name,
+        'size': size,
+        'iterations': iterations,
+        'bytes_per_sec': (2.0 * size * iterations) / elapsed,
+        'p50_ms': percentile(samples, 50) * 1000.0,
+        'p99_ms': percentile(samples, 99) * 1000.0
+    }
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--iterations", type=int, default=200,
+        help="round trips per payload size, default 200")
+    parser.add_argument("--codec", default="binary",
+        help="wire codec: binary (default), marshal or pickle")
+    parser.add_argument("--ring-size", type=int,
+        default=shmring.DEFAULT_RING_SIZE,
+        help="bytes of each shared memory ring, default %d (the pool's)" % \
+            shmring.DEFAULT_RING_SIZE)
+    args = parser.parse_args()
+
+    transports = [
+        ('pipe', lambda: jshandler.IOChannel(args.codec)),
+        ('shm', lambda: shmring.ShmChannel(args.codec, args.ring_size))
+    ]
+
+    print "%-6s %-6s %14s %10s %10s" % \
+        ('ipc', 'size', 'MB/s', 'p50 ms', 'p99 ms')
+    for label, size in Payloads:
+        # keep the big payloads from taking forever
+        n = args.iterations
+        if size >= 1024 * 1024:
+            n = max(10, n / 10)
+        for name, factory in transports:
+            r = run_case(name, factory, size, n)
+            print "%-6s %-6s %14.1f %10.3f %10.3f" % (name, label,
+                r['bytes_per_sec'] / (1024.0 * 1024.0), r['p50_ms'], r['p99_ms'])
@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+"""
+Multithreaded stress test of JsHandlerControl checkout/checkin.
+
+The pool is filled with stand-in handlers (no child processes) and many
+threads check slots out and in while the pool invariants are verified:
+
+  * a slot never has more than 'pipeline' requests in flight
+  * every live slot sits in exactly the free list matching its load
+  * the in flight count of every slot covers what the threads hold
+  * nothing is left checked out when the threads are done
+"""
+import os
+import sys
+import time
+import random
+import threading
+import argparse
+
+# repository root on sys.path, python engine when PyV8 is missing
+import benchenv
+
+# jsapi pulls in the rest of dnlib in the same order dreadnought.py does
+from dnlib import jsapi
+from dnlib import jshandler
+
+
+class StubHandler(object):
+    "stands in for a JSHandler without a child process"
+    def __init__(self):
+        self.faulted = False
+        self.timed_out = False
+
+    def detectChildFault(self):
+        return self.faulted
+
+    def close(self):
+        pass
+
+
+class StressPool(jshandler.JsHandlerControl):
+    def _overflow_iface(self):
+        return (StubHandler(), self.OVERFLOW_HANDLER_IDX)
+
+
+def check_invariants(pool, held):
+    pool.lock.acquire()
+    try:
+        for idx in range(len(pool.handlers)):
+            n = pool.inflight[idx]
+            assert 0 <= n <= pool.pipeline, "slot %d has %d in flight" % (idx, n)
+            # threads count a slot after checkout and stop before checkin
+            assert held.get(idx, 0) <= n, \
+                "slot %d in flight %d, threads hold %d" % (idx, n, held.get(idx, 0))
+            levels = [lvl for lvl in range(pool.pipeline) if idx in pool.free[lvl]]
+            if idx in pool.dead:
+                assert levels == [], "dead slot %d is still free" % idx
+            elif n < pool.pipeline:
+                assert levels == [n], "slot %d load %d in free lists %s" % \
+                    (idx, n, levels)
+            else:
+                assert levels == [], "full slot %d in free lists %s" % (idx, levels)
+    finally:
+        pool.lock.release()
+
+
+def stress(args):
+    pool = StressPool()
+    pool.pipeline = args.pipeline
+    pool.wait_timeout = args.wait_timeout
+    pool.queue_max = args.queue_max
+    pool.free = [jshandler.collections.OrderedDict() for i in range(args.pipeline)]
+    for i in range(args.pool):
+        pool._add_handler(StubHandler())
+
+    held = {}
+    held_lock = threading.Lock()
+    errors = []
+    done = threading.Event()
+
+    def client():
+        try:
+            for i in range(args.requests):
+                jsh, idx = pool.checkout()
+                if idx != pool.OVERFLOW_HANDLER_IDX:
+                    assert pool.handlers[idx] is jsh, "slot %d handler mismatch" % idx
+                    held_lock.acquire()
+                    held[idx] = held.get(idx, 0) + 1
+                    held_lock.release()
+                time.sleep(random.random() * args.hold)
+                if idx != pool.OVERFLOW_HANDLER_IDX:
+                    held_lock.acquire()
+                    held[idx] -= 1
+                    held_lock.release()
+                pool.checkin(jsh, idx)
+        except:
+            errors.append(sys.exc_info()[1])
+
+    def checker():
+        while not done.is_set():
+            held_lock.acquire()
+            try:
+                check_invariants(pool, held)
+            except AssertionError, e:
+                errors.append(e)
+            held_lock.release()
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=client) for i in range(args.threads)]
+    watch = threading.Thread(target=checker)
+    start = time.time()
+    watch.start()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    done.set()
+    watch.join()
+    elapsed = time.time() - start
+
+    check_invariants(pool, held)
+    assert sum(held.values()) == 0, held
+    stats = pool.stats()
+    assert stats['inflight'] == 0 and stats['busy'] == 0, stats
+    return errors, stats, elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--pool", type=int, default=8)
+    parser.add_argument("--pipeline", type=int, default=2)
+    parser.add_argument("--threads", type=int, default=64)
+    parser.add_argument("--requests", type=int, default=200,
+        help="checkouts per thread")
+    parser.add_argument("--hold", type=float, default=0.002,
+        help="maximum seconds a slot is held")
+    parser.add_argument("--wait-timeout", type=float, default=0.05)
+    parser.add_argument("--queue-max", type=int, default=100)
+    args = parser.parse_args()
+
+    errors, stats, elapsed = stress(args)
+    checkouts = args.threads * args.requests
+    print "%d checkouts in %.2fs, %d overflowed" % \
+        (checkouts, elapsed, stats['overflow'])
+    if errors:
+        for e in errors[:10]:
+            print "FAIL:", e
+        sys.exit(1)
+    print "OK"
@@ -0,0 +1,481 @@
+#!/usr/bin/env python
+"""
+Benchmark suite for the request pipeline, from a single channel round trip
+up to full HTTP requests through RootAPI.mainloop.
+
+  channel    request/response round trips over each IPC transport
+  pool       JsHandlerControl checkout/checkin under thread contention
+  overflow   transactions against a single busy process, most of them
+             served by the overflow handler
+  stream     RouteController.generator and push_generator throughput
+  http       keep-alive HTTP load against the cherrypy and async servers
+
+Every case runs in its own process so the global pool is set up fresh.
+Results (req/s, p50/p99 latency in ms, RSS in KB) are written as JSON with
+--json and can be compared against an earlier run with --compare, which
+exits with status 1 when a case regressed by more than --threshold.
+The python engine (dnlib/jsengine.py) is used when PyV8 is not installed.
+"""
+import os
+import sys
+import json
+import time
+import socket
+import signal
+import httplib
+import platform
+import tempfile
+import threading
+import subprocess
+import argparse
+
+# repository root on sys.path, python engine when PyV8 is missing
+import benchenv
+
+# jsapi pulls in the rest of dnlib in the same order dreadnought.py does
+from dnlib import jsapi
+from dnlib import jshandler
+from dnlib import jsroute
+
+from ipc_bench import percentile
+from pool_stress import StressPool, StubHandler
+
+
+Cases = ['channel', 'pool', 'overflow', 'stream', 'http']
+
+# metrics where a larger value is better, the rest are costs
+HIGHER_IS_BETTER = ('req_s', 'ops_s', 'mb_s')
+
+
+def latency(samples):
+    return {
+        'p50_ms': percentile(samples, 50) * 1000.0,
+        'p99_ms': percentile(samples, 99) * 1000.0
+    }
+
+
+def rss_kb(pid):
+    try:
+        for line in open('/proc/%d/status' % pid):
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+    except IOError:
+        pass
+    return 0
+
+
+def group_rss_kb(pgrp):
+    "resident memory of every process in a process group"
+    total = 0
+    for name in os.listdir('/proc'):
+        if not name.isdigit():
+            continue
+        try:
+            stat = open('/proc/%s/stat' % name).read()
+        except IOError:
+            continue
+        # the command name may hold spaces, fields restart after ')'
+        fields = stat[stat.rindex(')') + 2:].split()
+        if int(fields[2]) == pgrp:
+            total += rss_kb(int(name))
+    return total
+
+
+def isolated(func, *args):
+    """
+    Run func in a child process and return the dict it produced. The
+    result goes through a file, the processes the case forks inherit any
+    pipe and would hold it open, and they are killed with the case's
+    process group once it is done.
+    """
+    out = tempfile.TemporaryFile()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            os.setpgrp()
+            try:
+                result = func(*args)
+            except Exception, e:
+                result = {'error': '%s: %s' % (e.__class__.__name__, e)}
+            out.write(json.dumps(result))
+            out.flush()
+        finally:
+            os._exit(0)
+    os.waitpid(pid, 0)
+    try:
+        os.killpg(pid, signal.SIGKILL)
+    except OSError:
+        pass
+    out.seek(0)
+    data = out.read()
+    out.close()
+    if not data:
+        return {'error': 'benchmark process died'}
+    return json.loads(data)
+
+
+def hello(logger, req, args):
+    return {'data': '{"hello": "world"}'}
+
+
+def slow(logger, req, args):
+    time.sleep(0.002)
+    return {'data': 'done'}
+
+
+CHUNK = 'x' * 4096
+
+
+def pull_stream(logger, req, args):
+    # legacy streaming, called until it returns no data
+    if req.get('bytes_read', 0) >= 1024 * 1024:
+        return {'data': ''}
+    return {'data': CHUNK}
+
+
+def push_stream(logger, req, args, out):
+    for i in range(256):
+        out.write(CHUNK)
+    return {}
+
+
+def bench_channel(args):
+    results = {}
+    req = {
+        'path': '/bench',
+        'method': 'GET',
+        'qs_params': {'q': 'x' * 64},
+        'post_data': {'data': 'x' * 1024},
+        'ident': 0
+    }
+    for ipc in sorted(jshandler.Transports.keys()):
+        req_chan = jshandler.Transports[ipc]()
+        res_chan = jshandler.Transports[ipc]()
+        pid = os.fork()
+        if pid == 0:
+            try:
+                while True:
+                    obj = req_chan.recv()
+                    if obj is None:
+                        break
+                    res_chan.send(obj)
+            finally:
+                os._exit(0)
+
+        req_chan.send(req)
+        res_chan.recv()
+        samples = []
+        start = time.time()
+        for i in range(args.iterations):
+            t = time.time()
+            req_chan.send(req)
+            res_chan.recv()
+            samples.append(time.time() - t)
+        elapsed = time.time() - start
+        req_chan.send(None)
+        os.waitpid(pid, 0)
+
+        r = {'req_s': args.iterations / elapsed}
+        r.update(latency(samples))
+        results[ipc] = r
+    return results
+
+
+def bench_pool(args):
+    pool = StressPool()
+    pool.pipeline = 1
+    pool.wait_timeout = 0.05
+    pool.free = [jshandler.collections.OrderedDict()]
+    for i in range(args.pool):
+        pool._add_handler(StubHandler())
+
+    samples = []
+    lock = threading.Lock()
+
+    def client():
+        mine = []
+        for i in range(args.iterations):
+            t = time.time()
+            jsh, idx = pool.checkout()
+            mine.append(time.time() - t)
+            pool.checkin(jsh, idx)
+        lock.acquire()
+        samples.extend(mine)
+        lock.release()
+
+    threads = [threading.Thread(target=client) for i in range(args.threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    r = {'ops_s': len(samples) / elapsed, 'overflow': pool.stats()['overflow']}
+    r.update(latency(samples))
+    return r
+
+
+def _transactions(args, path, cb):
+    "threads running transactions on the global pool"
+    ident = jshandler.AddJsCb(path, cb, {})
+    jsroute.JsPool.setup(jsapi.HandlerAPI(), 1, wait_timeout=0.001)
+
+    samples = []
+    lock = threading.Lock()
+
+    def client():
+        mine = []
+        for i in range(args.iterations / 10):
+            t = time.time()
+            jsh, idx = jsroute.JsPool.checkout()
+            try:
+                jsh.transaction({'path': path, 'method': 'GET',
+                    'qs_params': {}, 'post_data': {}, 'ident': ident})
+            finally:
+                jsroute.JsPool.checkin(jsh, idx)
+            mine.append(time.time() - t)
+        lock.acquire()
+        samples.extend(mine)
+        lock.release()
+
+    threads = [threading.Thread(target=client) for i in range(args.threads)]
+    start = time.time()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.time() - start
+
+    stats = jsroute.JsPool.stats()
+    r = {'req_s': len(samples) / elapsed,
+         'overflow': stats['overflow'],
+         # checkout to a pre-forked process, or to a spare adopting it
+         'pool_wait_ms': stats['pool_wait']['avg_ms'],
+         'overflow_wait_ms': stats['overflow_wait']['avg_ms'],
+         'rss_kb': rss_kb(os.getpid())}
+    r.update(latency(samples))
+    return r
+
+
+def bench_overflow(args):
+    return _transactions(args, '/slow', slow)
+
+
+def bench_stream(args):
+    pull = jsroute.RouteController('/pull',
+        jshandler.AddJsCb('/pull', pull_stream, {'stream': True}),
+        {'stream': True})
+    push = jsroute.RouteController('/push',
+        jshandler.AddJsCb('/push', push_stream, {'stream': 'push'}),
+        {'stream': 'push'})
+    jsroute.JsPool.setup(jsapi.HandlerAPI(), 1)
+
+    results = {}
+    for (name, controller, generator) in (
+      ('generator', pull, pull.generator),
+      ('push_generator', push, push.push_generator)):
+        n = max(1, args.iterations / 100)
+        nbytes = 0
+        start = time.time()
+        for i in range(n):
+            jsh, idx = jsroute.JsPool.checkout()
+            req = controller._request('GET', {}, {})
+            for data in generator(jsh, idx, req, controller.options):
+                nbytes += len(data)
+        elapsed = time.time() - start
+        results[name] = {
+            'mb_s': nbytes / elapsed / (1024 * 1024),
+            'streams_s': n / elapsed
+        }
+    return results
+
+
+def _serve(server, port, pool):
+    "server process for the http case, never returns"
+    os.setpgrp()
+    devnull = os.open(os.devnull, os.O_RDWR)
+    os.dup2(devnull, 1)
+    os.dup2(devnull, 2)
+
+    import cherrypy
+    cherrypy.config.update({'environment': 'production', 'log.screen': False})
+    api = jsapi.RootAPI()
+    api.settings({'host': '127.0.0.1', 'port': port, 'js_pool': pool,
+        'server': server, 'favicon': '', 'metrics_path': ''})
+    api.register('/hello', hello, {})
+    api.mainloop()
+
+
+def _wait_listening(port, timeout=30.0):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        s = socket.socket()
+        try:
+            s.connect(('127.0.0.1', port))
+            return True
+        except socket.error:
+            time.sleep(0.1)
+        finally:
+            s.close()
+    return False
+
+
+def _load(port, threads, requests):
+    "keep-alive clients, returns (latencies, errors, elapsed)"
+    samples = []
+    errors = []
+    lock = threading.Lock()
+
+    def client():
+        mine = []
+        conn = httplib.HTTPConnection('127.0.0.1', port, timeout=30)
+        try:
+            for i in range(requests):
+                t = time.time()
+                conn.request('GET', '/hello')
+                res = conn.getresponse()
+                res.read()
+                if res.status != 200:
+                    raise IOError, "status %d" % res.status
+                mine.append(time.time() - t)
+        except Exception, e:
+            lock.acquire()
+            errors.append(str(e))
+            lock.release()
+        conn.close()
+        lock.acquire()
+        samples.extend(mine)
+        lock.release()
+
+    workers = [threading.Thread(target=client) for i in range(threads)]
+    start = time.time()
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    return (samples, errors, time.time() - start)
+
+
+def bench_http(args):
+    results = {}
+    for (i, server) in enumerate(('cherrypy', 'async')):
+        port = args.port + i
+        pid = os.fork()
+        if pid == 0:
+            try:
+                _serve(server, port, args.pool)
+            finally:
+                os._exit(0)
+        try:
+            if not _wait_listening(port):
+                results[server] = {'error': 'server did not start'}
+                continue
+            _load(port, 2, 20)   # warm up
+            (samples, errors, elapsed) = _load(port, args.threads,
+                args.iterations / 10)
+            r = {
+                'req_s': len(samples) / elapsed,
+                'errors': len(errors),
+                'rss_kb': group_rss_kb(pid),
+                'rss_parent_kb': rss_kb(pid)
+            }
+            if samples:
+                r.update(latency(samples))
+            results[server] = r
+        finally:
+            try:
+                os.killpg(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+    return results
+
+
+def flatten(results, prefix=''):
+    "{'http': {'async': {'req_s': 1}}} -> {'http.async.req_s': 1}"
+    out = {}
+    for (k, v) in results.items():
+        if type(v) == dict:
+            out.update(flatten(v, prefix + k + '.'))
+        else:
+            out[prefix + k] = v
+    return out
+
+
+def compare(base, current, threshold):
+    "print the change of every metric, returns the regressed metrics"
+    old = flatten(base['results'])
+    new = flatten(current['results'])
+    regressed = []
+    print "%-40s %12s %12s %8s" % ('metric', 'base', 'current', 'change')
+    for name in sorted(set(old) & set(new)):
+        (a, b) = (old[name], new[name])
+        if type(a) not in (int, float) or type(b) not in (int, float) or a == 0:
+            continue
+        change = (b - a) / float(a)
+        worse = -change if name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER else change
+        mark = ''
+        if name.endswith('_ms') or name.rsplit('.', 1)[-1] in HIGHER_IS_BETTER:
+            if worse > threshold:
+                mark = ' REGRESSED'
+                regressed.append(name)
+        print "%-40s %12.3f %12.3f %+7.1f%%%s" % (name, a, b, change * 100, mark)
+    return regressed
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=benchenv.BENCH_DIR, stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("cases", nargs="*", default=Cases,
+        help="cases to run, default all of %s" % ",".join(Cases))
+    parser.add_argument("--iterations", type=int, default=2000,
+        help="round trips per case, the slower cases scale it down")
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--pool", type=int, default=4,
+        help="javascript processes for the pool and http cases")
+    parser.add_argument("--port", type=int, default=18180,
+        help="first port used by the http case")
+    parser.add_argument("--json", metavar="FILE", help="write the results to FILE")
+    parser.add_argument("--compare", metavar="FILE",
+        help="compare with the results of an earlier run")
+    parser.add_argument("--threshold", type=float, default=0.1,
+        help="relative change counted as a regression, default 0.1")
+    args = parser.parse_args()
+
+    report = {
+        'commit': git_commit(),
+        'engine': benchenv.ENGINE,
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'args': {'iterations': args.iterations, 'threads': args.threads,
+                 'pool': args.pool},
+        'results': {}
+    }
+    for case in args.cases:
+        if case not in Cases:
+            sys.exit("unknown case %s, must be one of %s" % (case, ",".join(Cases)))
+        report['results'][case] = isolated(globals()['bench_' + case], args)
+        for (name, value) in sorted(flatten({case: report['results'][case]}).items()):
+            if type(value) == float:
+                value = '%.3f' % value
+            print "%-40s %s" % (name, value)
+
+    if args.json:
+        f = open(args.json, 'w')
+        json.dump(report, f, indent=2, sort_keys=True)
+        f.close()
+
+    if args.compare:
+        regressed = compare(json.load(open(args.compare)), report, args.threshold)
+        if regressed:
+            sys.exit(1)
@@ -3,11 +3,17 @@ Defines the api used by the javascript program to tie in directly
 into python.
 """
 
-import PyV8
+import jsengine
 import require
 import jshandler
 import cherrypy
 import jsroute
+import jsasync
+import jscompress
+import jstrace
+import jsprofile
+import jsreplay
+import jsmemory
 import logging
 import traceback
 import os
@@ -34,8 +40,9 @@ def _init_jscontext( c, scriptfile ):
     
 
 def expand(obj):
-    isObject = str(type(obj)).find('PyV8.JSObject') != -1
-    isArray  = str(type(obj)).find('PyV8.JSArray') != -1     
+    engine = jsengine.current()
+    isObject = engine.isObject(obj)
+    isArray  = engine.isArray(obj)
 
     if isObject or type(obj) == types.DictType:
         n = dict(obj)
@@ -49,13 +56,13 @@ def expand(obj):
     return n
 
  
-class HandlerAPI(PyV8.JSClass):
+class HandlerAPI(jsengine.JSClass):
     """
     API used by HTTP handlers. 
     """
 
     def __init__(self):
-        PyV8.JSClass.__init__(self)
+        jsengine.JSClass.__init__(self)
 
         for k,v in __builtins__.items():
             if k not in ("chr","ord","map","filter","reduce",\
@@ -72,11 +79,11 @@ class HandlerAPI(PyV8.JSClass):
             f = pyfuncobj(v)
             setattr(self,k,f) 
 
-    def isObject(self, obj):    return str(type(obj)).find('PyV8.JSObject') != -1
-    def isNULL(self, obj):      return str(type(obj)).find('PyV8.JSNULL') != -1
-    def isUndefined(self, obj): return str(type(obj)).find('PyV8.JSUndefined') != -1
-    def isArray(self, obj):     return str(type(obj)).find('PyV8.JSArray') != -1
-    def isFunction(self, obj):  return str(type(obj)).find('PyV8.JSFunction') != -1
+    def isObject(self, obj):    return jsengine.current().isObject(obj)
+    def isNULL(self, obj):      return jsengine.current().isNull(obj)
+    def isUndefined(self, obj): return jsengine.current().isUndefined(obj)
+    def isArray(self, obj):     return jsengine.current().isArray(obj)
+    def isFunction(self, obj):  return jsengine.current().isFunction(obj)
     def isInt(self, obj):       return type(obj) == type(0)
     def isFloat(self, obj):     return type(obj) == type(0.0)
 
@@ -161,13 +168,36 @@ class RootAPI(HandlerAPI):
 
         self.logger = RootLogger()
         self.registry = jsroute.RouteRegistry( HandlerAPI() )
-        
+
+        # options of 'dn replay', mainloop replays a traffic log instead
+        # of serving http when set
+        self.replay = None
 
         self._settings = {
             'host'        :"0.0.0.0",
             'port'        : 8080,
             'thread_pool' : 20,
             'js_pool'     : 20,
+            'js_pipeline' : 1,
+            'js_wait_timeout': 0.1,
+            'js_queue_max': 100,
+            'js_pool_min' : None,
+            'js_pool_max' : None,
+            'js_idle_cooldown': 60,
+            'js_hang_timeout': 0,
+            'js_timeout'  : 0,
+            'js_overflow_spares': 2,
+            'max_requests_per_worker': 0,
+            'max_rss_per_worker': 0,
+            'ipc'         : 'pipe',
+            'codec'       : 'binary',
+            'server'      : 'cherrypy',
+            'compress'    : False,
+            'metrics_path': '/metrics',
+            'trace'       : False,
+            'profile'     : None,
+            'record'      : None,
+            'warmup'      : None,
             'favicon'     : os.environ['HOME']+"/.dreadnought-js/favicon.ico"
         }
 
@@ -193,10 +223,68 @@ class RootAPI(HandlerAPI):
 
     def mainloop(self):
         "Interface to cherrypy's mainloop"
+
+        if self.replay:
+            # pool settings given on the command line win
+            self._settings.update( self.replay['settings'] )
                  
+        # the javascript processes pick up the profiler settings
+        jsprofile.configure( self._settings.get('profile',None) )
+
+        # load what the handlers need before forking so it stays shared
+        jsmemory.warmup( self._settings.get('warmup',None) )
+
         # launch a set of child processes to handle each request
         # within a child process. 
-        self.registry.start_processes( self._settings.get('js_pool',20) )
+        self.registry.start_processes( self._settings.get('js_pool',20),
+            ipc=self._settings.get('ipc','pipe'),
+            codec=self._settings.get('codec','binary'),
+            pipeline=self._settings.get('js_pipeline',1),
+            wait_timeout=self._settings.get('js_wait_timeout',0.1),
+            queue_max=self._settings.get('js_queue_max',100),
+            pool_min=self._settings.get('js_pool_min',None),
+            pool_max=self._settings.get('js_pool_max',None),
+            idle_cooldown=self._settings.get('js_idle_cooldown',60),
+            hang_timeout=self._settings.get('js_hang_timeout',0),
+            overflow_spares=self._settings.get('js_overflow_spares',2),
+            max_requests=self._settings.get('max_requests_per_worker',0),
+            max_rss=self._settings.get('max_rss_per_worker',0),
+            timeout=self._settings.get('js_timeout',0) )
+
+        if self.replay:
+            result = jsreplay.replay( self.registry, jsroute.JsPool,
+                jsreplay.load( self.replay['log'] ),
+                speed=self.replay.get('speed',1.0),
+                threads=self.replay.get('threads',jsreplay.DEFAULT_THREADS) )
+            print jsreplay.report( result )
+            if self.replay.get('json',None):
+                f = open( self.replay['json'], 'w' )
+                json.dump( result, f, indent=2, sort_keys=True )
+                f.close()
+            return
+
+        jscompress.configure( self._settings.get('compress',False) )
+        jstrace.configure( self._settings.get('trace',False) )
+        jsreplay.configure( self._settings.get('record',None) )
+        # the traffic log must be complete once the server stops
+        cherrypy.engine.subscribe( 'stop', jsreplay.close )
+        jsprofile.installToggle( jsroute.JsPool.pids )
+
+        metrics_path = self._settings.get('metrics_path','/metrics')
+        if metrics_path:
+            self.registry.register_metrics( metrics_path )
+
+        if self._settings.get('server','cherrypy') == 'async':
+            # single event loop thread instead of the cherrypy thread pool
+            server = jsasync.AsyncServer( self.registry, jsroute.JsPool,
+                host=self._settings.get('host',"0.0.0.0"),
+                port=self._settings.get('port',8080),
+                idle_timeout=self._settings.get('idle_timeout',60) )
+            try:
+                server.serve_forever()
+            finally:
+                jsreplay.close()
+            return
 
         self._config['global'] = {
             'server.socket_host' : self._settings.get('host',"0.0.0.0"),
@@ -247,12 +335,17 @@ def run( scriptfile, opts  ):
 
     code = open(scriptfile).read()
     api = RootAPI() 
-    root_context = PyV8.JSContext( api )
+    api.replay = opts.get('replay',None)
+    if opts.get('profile',None):
+        api.settings({'profile': {'dir': opts['profile'],
+            'interval': opts.get('profile_interval',None) or \
+                jsprofile.DEFAULT_INTERVAL}})
+    root_context = jsengine.current().createContext( api )
     root_context.enter()
 
     _init_jscontext( root_context, scriptfile )
     try:
-        root_context.eval( code )
+        jsengine.current().eval( root_context, code )
     except KeyboardInterrupt:
         pass 
     root_context.leave()   
@@ -0,0 +1,762 @@
+"""
+Event loop front end, an alternative to the cherrypy thread pool. A single
+thread multiplexes the client connections together with the response pipes
+of the javascript child processes, so a slow javascript handler only ties
+up a slot in the process pool instead of a server thread. Requests that
+find every child busy wait in a queue rather than forking overflow
+processes.
+
+Requests are dispatched through the same RouteRegistry and JsCbLookup
+tables as the cherrypy server. Sessions, static content and the favicon
+are only served by the cherrypy server, the async server refuses to start
+when a route has a permissionLevel it could not check.
+"""
+import os
+import socket
+import select
+import errno
+import time
+import logging
+import traceback
+import urllib
+import urlparse
+import cgi
+import collections
+from cStringIO import StringIO
+from BaseHTTPServer import BaseHTTPRequestHandler
+import cherrypy
+import jshandler
+import jsmetrics
+
+
+# largest request line + headers accepted
+MAX_HEADER = 64 * 1024
+
+READ_SIZE = 64 * 1024
+
+# stop asking a worker for stream chunks while this much output is queued
+STREAM_HIGH_WATER = 256 * 1024
+
+DEFAULT_CONTENT_TYPE = 'text/html;charset=utf-8'
+
+
+
+class Poller(object):
+    "select.epoll when available, select.poll otherwise"
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.p = select.epoll()
+            self.scale = 1.0
+            self.IN = select.EPOLLIN
+            self.OUT = select.EPOLLOUT
+        else:
+            self.p = select.poll()
+            self.scale = 1000.0
+            self.IN = select.POLLIN
+            self.OUT = select.POLLOUT
+
+    def register(self, fd, events):
+        self.p.register(fd, events)
+
+    def modify(self, fd, events):
+        self.p.modify(fd, events)
+
+    def unregister(self, fd):
+        self.p.unregister(fd)
+
+    def poll(self, timeout):
+        "timeout in seconds"
+        return self.p.poll(timeout * self.scale)
+
+
+
+def _merge_params(qs_params, post_data):
+    # cherrypy hands the controller query string and post parameters in
+    # one dictionary, do the same so RouteController can split them again.
+    params = dict(qs_params)
+    for k, v in post_data.items():
+        if k in params:
+            if type(params[k]) != type([]):
+                params[k] = [params[k]]
+            params[k].append(v)
+        else:
+            params[k] = v
+    return params
+
+
+def _parse_qs(query):
+    "single values as strings and repeated ones as lists, like cherrypy"
+    params = {}
+    for k, v in urlparse.parse_qs(query, keep_blank_values=True).items():
+        if len(v) == 1:
+            params[k] = v[0]
+        else:
+            params[k] = v
+    return params
+
+
+def _parse_body(headers, body):
+    ctype = headers.get('content-type', '')
+    if ctype.startswith('application/x-www-form-urlencoded'):
+        return _parse_qs(body)
+    elif ctype.startswith('multipart/form-data'):
+        environ = {
+            'REQUEST_METHOD': 'POST',
+            'CONTENT_TYPE': ctype,
+            'CONTENT_LENGTH': str(len(body))
+        }
+        fs = cgi.FieldStorage(fp=StringIO(body), environ=environ,
+            keep_blank_values=True)
+        params = {}
+        for k in fs.keys():
+            v = fs.getlist(k)
+            if len(v) == 1:
+                params[k] = v[0]
+            else:
+                params[k] = v
+        return params
+    return {}
+
+
+
+class Connection(object):
+    "One client connection, parses requests and buffers the output"
+
+    def __init__(self, server, sock, addr):
+        self.server = server
+        self.sock = sock
+        self.addr = addr
+        self.fd = sock.fileno()
+        self.inbuf = ''
+        self.outbuf = collections.deque()
+        self.outlen = 0
+        self.closed = False
+        self.busy = False         # a request is being serviced
+        self.keep_alive = False
+        self.on_drain = None      # called once the output buffer empties
+        self.last_active = time.time()
+
+        # request being read
+        self.head = None
+        self.body = []
+        self.body_len = 0
+
+    def events(self):
+        events = self.server.poller.IN
+        if self.outlen > 0:
+            events |= self.server.poller.OUT
+        return events
+
+    def handle(self, evt):
+        self.last_active = time.time()
+        if evt & self.server.poller.OUT:
+            self._flush()
+        if evt & ~(self.server.poller.IN | self.server.poller.OUT):
+            self.close()
+        elif evt & self.server.poller.IN and not self.closed:
+            self._read()
+
+    def _read(self):
+        try:
+            data = self.sock.recv(READ_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.close()
+            return
+        if self.head is None:
+            self.inbuf += data
+        else:
+            self.body.append(data)
+            self.body_len += len(data)
+        self._parse()
+
+    def _parse(self):
+        if self.busy or self.closed:
+            return
+
+        if self.head is None:
+            end = self.inbuf.find('\r\n\r\n')
+            if end < 0:
+                if len(self.inbuf) > MAX_HEADER:
+                    self.error(431, "Request header fields too large")
+                return
+            try:
+                self.head = self._parse_head(self.inbuf[:end])
+            except ValueError, e:
+                self.error(400, str(e))
+                return
+            rest = self.inbuf[end+4:]
+            self.inbuf = ''
+            self.body = [rest]
+            self.body_len = len(rest)
+
+        (method, target, version, headers, length) = self.head
+        if self.body_len < length:
+            return
+
+        body = ''.join(self.body)
+        # anything past the body belongs to the next request
+        self.inbuf = body[length:]
+        body = body[:length]
+        self.head = None
+        self.body = []
+        self.body_len = 0
+
+        self.busy = True
+        self.keep_alive = self._keep_alive(version, headers)
+        self.version = version
+        self.headers = headers
+        self.server.dispatch(self, method, target, headers, body)
+
+    def _parse_head(self, data):
+        lines = data.split('\r\n')
+        parts = lines[0].split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise ValueError, "malformed request line"
+        headers = {}
+        for line in lines[1:]:
+            k, sep, v = line.partition(':')
+            if not sep:
+                raise ValueError, "malformed header"
+            headers[k.strip().lower()] = v.strip()
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            raise ValueError, "chunked request bodies are not supported"
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            raise ValueError, "bad content-length"
+        if length > self.server.max_body:
+            raise ValueError, "request body too large"
+        return (parts[0].upper(), parts[1], parts[2], headers, length)
+
+    def _keep_alive(self, version, headers):
+        conn = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            return conn != 'close'
+        return conn == 'keep-alive'
+
+    def write(self, data):
+        if self.closed or not data:
+            return
+        if type(data) == unicode:
+            data = data.encode('utf-8')
+        self.outbuf.append(data)
+        self.outlen += len(data)
+        self._flush()
+
+    def _flush(self):
+        while self.outbuf and not self.closed:
+            data = self.outbuf[0]
+            try:
+                n = self.sock.send(data)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    break
+                self.close()
+                return
+            self.outlen -= n
+            if n < len(data):
+                self.outbuf[0] = data[n:]
+                break
+            self.outbuf.popleft()
+
+        if not self.closed:
+            self.server.poller.modify(self.fd, self.events())
+            if self.outlen == 0 and self.on_drain:
+                cb, self.on_drain = self.on_drain, None
+                cb()
+
+    def start_response(self, status, headers, length=None):
+        reason = BaseHTTPRequestHandler.responses.get(status, ('',))[0]
+        lines = ["%s %d %s" % (self.version, status, reason)]
+        for k, v in headers:
+            lines.append("%s: %s" % (k, v))
+        if length is not None:
+            lines.append("Content-Length: %d" % length)
+        if self.keep_alive:
+            lines.append("Connection: keep-alive")
+        else:
+            lines.append("Connection: close")
+        self.write('\r\n'.join(lines) + '\r\n\r\n')
+
+    def respond(self, status, body, ctype=DEFAULT_CONTENT_TYPE, headers=None):
+        headers = (headers or {}).items()
+        if status == 304:
+            # no body, not even a Content-Length
+            self.start_response(status, headers)
+            self.finish()
+            return
+        if type(body) == unicode:
+            body = body.encode('utf-8')
+        elif type(body) != str:
+            body = str(body)
+        self.start_response(status, [('Content-Type', ctype)] + headers, len(body))
+        self.write(body)
+        self.finish()
+
+    def failed(self, status):
+        "answer a server error with its reason only, the details are logged"
+        reason = BaseHTTPRequestHandler.responses.get(status, ('',))[0]
+        self.respond(status, reason or "Server Error", 'text/plain;charset=utf-8')
+
+    def error(self, status, message):
+        self.keep_alive = False
+        if not hasattr(self, 'version'):
+            self.version = 'HTTP/1.1'
+        self.respond(status, message, 'text/plain;charset=utf-8')
+
+    def finish(self):
+        "request complete, close or wait for the next one"
+        self.busy = False
+        if not self.keep_alive:
+            if self.outlen == 0:
+                self.close()
+            else:
+                self.on_drain = self.close
+        elif self.inbuf:
+            self._parse()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.server.remove(self)
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+
+class _Stream(object):
+    """
+    Drives a streaming route over the javascript stream protocol, chunks are
+    requested from the worker only while the client keeps up.
+    """
+    def __init__(self, server, conn, controller, jsh, idx, req):
+        self.server = server
+        self.conn = conn
+        self.controller = controller
+        self.jsh = jsh
+        self.idx = idx
+        self.req = req
+        self.chunked = conn.version == 'HTTP/1.1'
+        self.started = False
+        if not self.chunked:
+            conn.keep_alive = False
+
+    def start(self):
+        self.req['streaming'] = True
+        self.req['bytes_read'] = 0
+        self._next()
+
+    def _start_response(self):
+        headers = [('Content-Type', DEFAULT_CONTENT_TYPE)]
+        if self.chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        self.conn.start_response(200, headers)
+        self.started = True
+
+    def _next(self):
+        self.jsh.submit(self.req, self._chunk)
+
+    def _chunk(self, res):
+        if 'error' in res or 'exc' in res:
+            self._done(res.get('error', res.get('exc')))
+            return
+
+        data = res.get('data', None)
+        if not data or len(data) == 0 or self.conn.closed:
+            self._done(None)
+            return
+
+        if type(data) == unicode:
+            data = data.encode('utf-8')
+        if not self.started:
+            # the first chunk decides between a 200 and an error
+            self._start_response()
+        self.req['bytes_read'] += len(data)
+        if self.chunked:
+            self.conn.write("%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.conn.write(data)
+
+        if self.conn.outlen < STREAM_HIGH_WATER:
+            self._next()
+        else:
+            # resume once the client has caught up
+            self.conn.on_drain = self._next
+
+    def _done(self, error):
+        if error:
+            logging.error("stream %s failed: %s" % (self.req['path'], error))
+            self.conn.keep_alive = False
+
+        self.server.checkin(self.jsh, self.idx)
+        if not self.started:
+            if error:
+                self.conn.failed(500)
+                return
+            # empty stream
+            self._start_response()
+        if self.chunked and not error:
+            self.conn.write("0\r\n\r\n")
+        self.conn.finish()
+
+
+class _PushStream(object):
+    """
+    Drives a push streaming route, the worker sends chunks as the callback
+    writes them. Credit for more chunks is returned while the client keeps
+    up and held back once STREAM_HIGH_WATER bytes are queued.
+    """
+    def __init__(self, server, conn, controller, jsh, idx, req):
+        self.server = server
+        self.conn = conn
+        self.controller = controller
+        self.jsh = jsh
+        self.idx = idx
+        self.req = req
+        self.window = controller.options.get('window', jshandler.STREAM_WINDOW)
+        self.chunked = conn.version == 'HTTP/1.1'
+        self.started = False
+        self.done = False
+        self.owed = 0
+        self.rid = None
+        if not self.chunked:
+            conn.keep_alive = False
+
+    def start(self):
+        try:
+            self.rid = self.jsh.submit(self.req, self._end, self._chunk,
+                self.window)
+        except:
+            self._end({'exc': traceback.format_exc()})
+
+    def _start_response(self):
+        headers = [('Content-Type', DEFAULT_CONTENT_TYPE)]
+        if self.chunked:
+            headers.append(('Transfer-Encoding', 'chunked'))
+        self.conn.start_response(200, headers)
+        self.started = True
+
+    def _chunk(self, data):
+        if self.conn.closed:
+            if not self.done:
+                # client went away, stop the callback at its next write
+                self.done = True
+                self.jsh.cancel(self.rid)
+            return
+
+        if not self.started:
+            self._start_response()
+        if type(data) == unicode:
+            data = data.encode('utf-8')
+        if self.chunked:
+            self.conn.write("%x\r\n%s\r\n" % (len(data), data))
+        else:
+            self.conn.write(data)
+
+        self.owed += 1
+        if self.conn.outlen >= STREAM_HIGH_WATER:
+            # resume once the client has caught up
+            self.conn.on_drain = self._grant
+        elif self.owed >= max(1, self.window / 2):
+            self._grant()
+
+    def _grant(self):
+        if self.owed and not self.done:
+            self.jsh.grant(self.rid, self.owed)
+            self.owed = 0
+
+    def _end(self, res):
+        self.done = True
+        self.server.checkin(self.jsh, self.idx)
+        if self.conn.closed:
+            return
+
+        error = res.get('exc', res.get('error'))
+        if error:
+            logging.error("stream %s failed: %s" % (self.req['path'], error))
+            if not self.started:
+                self.conn.failed(500)
+                return
+            self.conn.keep_alive = False
+        else:
+            if not self.started:
+                self._start_response()
+            if self.chunked:
+                self.conn.write("0\r\n\r\n")
+        self.conn.finish()
+
+
+
+class AsyncServer(object):
+    """
+    HTTP server running on one event loop thread. Replies from the child
+    processes are read when their pipes become readable, requests that find
+    every child busy wait in a FIFO queue for a free slot.
+    """
+
+    def __init__(self, registry, pool, host="0.0.0.0", port=8080,
+      idle_timeout=60, max_body=100*1024*1024, backlog=1024):
+        for controller in registry.controllers:
+            if 'permissionLevel' in controller.options:
+                raise ValueError, "route %s has a permissionLevel, which " \
+                    "needs the sessions of the cherrypy server" % controller.path
+        self.registry = registry
+        self.pool = pool
+        self.host = host
+        self.port = port
+        self.idle_timeout = idle_timeout
+        self.max_body = max_body
+        self.backlog = backlog
+        self.poller = Poller()
+        self.handlers = {}
+        self.connections = {}
+        self.waiting = collections.deque()
+        self.sock = None
+
+        # the autoscaler and the supervisor add, remove and fail child
+        # processes from their own threads, changes are queued and the loop
+        # is woken up through a pipe so callbacks only run on the loop.
+        self.pool_events = collections.deque()
+        self.wake_r, self.wake_w = os.pipe()
+        pool.watchers.append( self._pool_changed )
+        pool.queue_depth.append( lambda: len(self.waiting) )
+        pool.child_fds.append( self._fds )
+
+    def _fds(self):
+        "sockets and pipes child processes forked later must not keep open"
+        fds = [self.wake_r, self.wake_w] + self.connections.keys()
+        if self.sock:
+            fds.append( self.sock.fileno() )
+        return fds
+
+    def add(self, fd, events, handler):
+        self.handlers[fd] = handler
+        self.poller.register(fd, events)
+
+    def remove(self, conn):
+        self.connections.pop(conn.fd, None)
+        if self.handlers.pop(conn.fd, None):
+            self.poller.unregister(conn.fd)
+
+    def _listen(self):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((self.host, self.port))
+        self.sock.listen(self.backlog)
+        self.sock.setblocking(0)
+        self.add(self.sock.fileno(), self.poller.IN, self._accept)
+
+    def _accept(self, evt):
+        while True:
+            try:
+                sock, addr = self.sock.accept()
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                    return
+                if e.args[0] in (errno.EMFILE, errno.ENFILE):
+                    logging.error("out of file descriptors, accept failed")
+                    return
+                raise
+            sock.setblocking(0)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            conn = Connection(self, sock, addr)
+            self.connections[conn.fd] = conn
+            self.add(conn.fd, conn.events(), conn.handle)
+
+    def _register_workers(self):
+        self.add(self.wake_r, self.poller.IN, self._wakeup)
+        for jsh in self.pool.handlers:
+            self.add(jsh.res_chan.fileno(), self.poller.IN,
+                self._worker_event(jsh))
+
+    def _worker_event(self, jsh):
+        def handler(evt):
+            if evt & self.poller.IN:
+                try:
+                    jsh.read_reply()
+                except:
+                    jsh._fail_pending(traceback.format_exc())
+            else:
+                fd = jsh.res_chan.fileno()
+                logging.error("child process pipe %d failed event=%x" % (fd, evt))
+                self.handlers.pop(fd, None)
+                self.poller.unregister(fd)
+                jsh._fail_pending("response_pipe error event=%x" % evt)
+        return handler
+
+    def _pool_changed(self, event, jsh, *args):
+        self.pool_events.append( (event, jsh, args) )
+        os.write(self.wake_w, 'x')
+
+    def _wakeup(self, evt):
+        os.read(self.wake_r, 4096)
+        while self.pool_events:
+            (event, jsh, args) = self.pool_events.popleft()
+            fd = jsh.res_chan.fileno()
+            if event == 'add':
+                self.add(fd, self.poller.IN, self._worker_event(jsh))
+            elif event == 'fail':
+                jsh._fail_pending(*args)
+            else:
+                if self.handlers.pop(fd, None):
+                    self.poller.unregister(fd)
+                jsh.close()
+        self._pump()
+
+    def dispatch(self, conn, method, target, headers, body):
+        path, sep, query = target.partition('?')
+        path = urllib.unquote(path)
+
+        match = self.registry.dispatch.mapper.match(environ={
+            'PATH_INFO': path,
+            'REQUEST_METHOD': method
+        })
+        if not match:
+            conn.respond(404, "The path '%s' was not found." % path,
+                'text/plain;charset=utf-8')
+            return
+
+        controller = self.registry.dispatch.controllers[match['controller']]
+        if isinstance(controller, jsmetrics.MetricsController):
+            conn.respond(200, controller.render(), jsmetrics.CONTENT_TYPE)
+            return
+        conn.started = time.time()
+        qs_params = _parse_qs(query)
+        for k, v in match.items():
+            if k not in ('controller', 'action'):
+                qs_params[k] = v
+
+        post_data = _parse_body(headers, body)
+        req = controller._request(method,
+            _merge_params(qs_params, post_data), post_data)
+
+        key = controller._cache_key(req)
+        hit = controller._lookup(key, headers.get('if-none-match'),
+            headers.get('if-modified-since'))
+        if hit:
+            (status, hdrs, data) = hit
+            (hdrs, data) = controller._encode(status, hdrs, data,
+                headers.get('accept-encoding'))
+            conn.respond(status, data, headers=hdrs)
+            jsmetrics.recordRequest(controller.path, method, status,
+                conn.started, done=time.time())
+            return
+        controller._conditional(req, headers.get('if-none-match'))
+        self._run(conn, controller, req)
+
+    def _run(self, conn, controller, req, slot=None):
+        if conn.closed:
+            return
+        if slot is None:
+            slot = self.pool.try_checkout()
+        if slot is None:
+            self.waiting.append((conn, controller, req))
+            return
+        (jsh, idx) = slot
+        checked_out = time.time()
+
+        if controller.options.get('stream', False) == 'push':
+            _PushStream(self, conn, controller, jsh, idx, req).start()
+            return
+        elif controller.options.get('stream', False):
+            _Stream(self, conn, controller, jsh, idx, req).start()
+            return
+
+        def reply(res):
+            self.checkin(jsh, idx)
+            replied = time.time()
+            (status, size) = self._respond(conn, controller, req, res)
+            controller._record(req, status, conn.started, checked_out,
+                replied, res, size)
+        controller._sample(req)
+        try:
+            jsh.submit(req, reply)
+        except:
+            reply({'exc': traceback.format_exc()})
+
+    def checkin(self, jsh, idx):
+        self.pool.checkin(jsh, idx)
+        self._pump()
+
+    def _pump(self):
+        "start waiting requests while there are free slots"
+        while self.waiting:
+            slot = self.pool.try_checkout()
+            if slot is None:
+                return
+            (conn, controller, req) = self.waiting.popleft()
+            if conn.closed:
+                self.pool.checkin(*slot)
+            else:
+                self._run(conn, controller, req, slot)
+
+    def _respond(self, conn, controller, req, res):
+        "send the reply for a handler result, returns (status, body size)"
+        if conn.closed:
+            return (499, None)
+        try:
+            (status, headers, data) = controller._reply(
+                controller._cache_key(req), res,
+                conn.headers.get('if-none-match'),
+                conn.headers.get('if-modified-since'))
+            size = len(data or '')
+            (headers, data) = controller._encode(status, headers, data,
+                conn.headers.get('accept-encoding'))
+        except cherrypy.HTTPError, e:
+            if e.code < 500:
+                conn.respond(e.code, e._message, 'text/plain;charset=utf-8')
+            else:
+                # the exception of the callback is logged, not sent
+                logging.error("%s failed with %d\n%s" % (req['path'],
+                    e.code, e._message))
+                conn.failed(e.code)
+            return (e.code, None)
+        except:
+            # logged like cherrypy does, the client only learns it failed
+            logging.error("reply to %s failed\n%s" % (req['path'],
+                traceback.format_exc()))
+            conn.failed(500)
+            return (500, None)
+        conn.respond(status, data, headers=headers)
+        return (status, size)
+
+    def _sweep(self):
+        "close idle keep-alive connections"
+        now = time.time()
+        for conn in self.connections.values():
+            if not conn.busy and conn.outlen == 0 and \
+              now - conn.last_active > self.idle_timeout:
+                conn.close()
+
+    def serve_forever(self):
+        self._listen()
+        self._register_workers()
+        logging.info("async server listening on %s:%d" % (self.host, self.port))
+
+        last_sweep = time.time()
+        while True:
+            try:
+                events = self.poller.poll(1.0)
+            except (IOError, select.error), e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            for (fd, evt) in events:
+                handler = self.handlers.get(fd)
+                if handler:
+                    try:
+                        handler(evt)
+                    except:
+                        logging.error(traceback.format_exc())
+
+            if time.time() - last_sweep > 1.0:
+                self._sweep()
+                last_sweep = time.time()
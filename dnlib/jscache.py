@@ -0,0 +1,202 @@
+"""
+Response cache kept in the cherrypy process. A route registered with a
+'cache' option answers repeated requests for the same query parameters
+without checking out a javascript process.
+
+    dn.register('/report', cb, {
+        cache: {ttl: 30, max_entries: 1000, max_bytes: 8*1024*1024,
+                vary: ['year','month']}
+    });
+
+'vary' limits the query parameters that make up the cache key, by default
+all of them are used. Requests carrying post data are never cached.
+
+A handler can steer caching of one response with a 'cache' field in its
+result: false skips storing it, a number stores it for that many seconds.
+
+The validators used for conditional GET (ETag, Last-Modified) live here
+as well, they are kept next to cached bodies so a hit can still be
+answered with 304 Not Modified.
+"""
+import time
+import threading
+import collections
+import hashlib
+import email.utils
+
+
+DEFAULT_TTL = 60
+DEFAULT_MAX_ENTRIES = 1000
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+def _hashable(v):
+    "query parameter value usable in a cache key"
+    if type(v) == list or type(v) == tuple:
+        return tuple([_hashable(x) for x in v])
+    if type(v) == dict:
+        return tuple(sorted([(k, _hashable(x)) for k, x in v.items()]))
+    return v
+
+
+class ResponseCache(object):
+    """
+    LRU cache of response bodies with a time to live, bounded both by the
+    number of entries and by their total size.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES,
+      max_bytes=DEFAULT_MAX_BYTES, vary=None):
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.vary = vary
+        self.entries = collections.OrderedDict()   # key -> (expires, data, size, meta)
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def key(self, qs_params):
+        if self.vary is None:
+            names = qs_params.keys()
+        else:
+            names = [k for k in self.vary if k in qs_params]
+        return tuple(sorted([(k, _hashable(qs_params[k])) for k in names]))
+
+    def get(self, key):
+        "(body, meta) cached for key or None, counts a hit or a miss"
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] <= time.time():
+                self._drop(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            # most recently used entries live at the end
+            del self.entries[key]
+            self.entries[key] = entry
+            self.hits += 1
+            return (entry[1], entry[3])
+        finally:
+            self.lock.release()
+
+    def put(self, key, data, directive=None, meta=None):
+        """
+        Store a response body along with 'meta' (the response headers).
+        'directive' is the 'cache' field of the handler result: False keeps
+        the body out of the cache, a number overrides the ttl.
+        """
+        if directive is False or directive == 0:
+            return
+        ttl = self.ttl
+        if directive is not None and directive is not True:
+            ttl = float(directive)
+
+        if type(data) == str or type(data) == unicode:
+            size = len(data)
+        else:
+            size = len(str(data))
+        if size > self.max_bytes:
+            return
+
+        self.lock.acquire()
+        try:
+            if key in self.entries:
+                self._drop(key)
+            self.entries[key] = (time.time() + ttl, data, size, meta)
+            self.size += size
+            while len(self.entries) > self.max_entries or self.size > self.max_bytes:
+                self._drop(self.entries.iterkeys().next())
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def _drop(self, key):
+        # must hold the lock
+        entry = self.entries.pop(key)
+        self.size -= entry[2]
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            self.entries.clear()
+            self.size = 0
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions
+            }
+        finally:
+            self.lock.release()
+
+
+def fromOptions(options):
+    "build a cache from the 'cache' route option, None if caching is off"
+    if not options:
+        return None
+    if options is True:
+        return ResponseCache()
+    opt = dict(options)
+    vary = opt.get('vary', None)
+    if vary is not None:
+        vary = [str(k) for k in vary]
+    return ResponseCache(opt.get('ttl', DEFAULT_TTL),
+        opt.get('max_entries', DEFAULT_MAX_ENTRIES),
+        opt.get('max_bytes', DEFAULT_MAX_BYTES), vary)
+
+
+def makeETag(data):
+    "strong entity tag computed from a response body"
+    if type(data) == unicode:
+        data = data.encode('utf-8')
+    elif type(data) != str:
+        data = str(data)
+    return '"%s"' % hashlib.md5(data).hexdigest()
+
+
+def quoteETag(tag):
+    "entity tag supplied by a handler, quoted unless it already is"
+    tag = str(tag)
+    if tag.startswith('"') or tag.startswith('W/"'):
+        return tag
+    return '"%s"' % tag
+
+
+def _opaque(tag):
+    tag = tag.strip()
+    if tag.startswith('W/'):
+        return tag[2:]
+    return tag
+
+
+def etagMatches(header, etag):
+    "weak comparison of an If-None-Match header against an entity tag"
+    if not header or not etag:
+        return False
+    if header.strip() == '*':
+        return True
+    return _opaque(etag) in [_opaque(t) for t in header.split(',')]
+
+
+def httpDate(seconds):
+    return email.utils.formatdate(float(seconds), usegmt=True)
+
+
+def notModifiedSince(header, last_modified):
+    "True if an If-Modified-Since header covers a Last-Modified date"
+    since = email.utils.parsedate_tz(header or '')
+    modified = email.utils.parsedate_tz(last_modified or '')
+    if since is None or modified is None:
+        return False
+    return email.utils.mktime_tz(modified) <= email.utils.mktime_tz(since)
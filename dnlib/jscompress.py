@@ -0,0 +1,182 @@
+"""
+Response compression done in the cherrypy process. The encoding is
+negotiated from Accept-Encoding (gzip preferred over deflate), bodies below
+'min_size' bytes are sent as is.
+
+Compressed bodies are kept in a small LRU cache keyed by a hash of the
+uncompressed body so repeated identical responses are only compressed once.
+
+Enabled for every route with the 'compress' setting or per route with the
+'compress' option, either true or {min_size: 1024, level: 6}. A route can
+turn it off with compress: false.
+"""
+import zlib
+import hashlib
+import threading
+import collections
+
+
+DEFAULT_MIN_SIZE = 1024
+DEFAULT_LEVEL = 6
+DEFAULT_CACHE_ENTRIES = 256
+DEFAULT_CACHE_BYTES = 8 * 1024 * 1024
+
+# zlib window bits producing each content coding
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS
+}
+
+# global compressor set up from the 'compress' setting
+Default = None
+
+
+def negotiate(accept_encoding):
+    "content coding to use for an Accept-Encoding header or None"
+    if not accept_encoding:
+        return None
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = item.strip().split(';')
+        q = 1.0
+        for p in parts[1:]:
+            k, sep, v = p.strip().partition('=')
+            if k == 'q':
+                try:
+                    q = float(v)
+                except ValueError:
+                    q = 0.0
+        accepted[parts[0].strip().lower()] = q
+    for coding in ('gzip', 'deflate'):
+        q = accepted.get(coding, accepted.get('*', 0.0))
+        if q > 0:
+            return coding
+    return None
+
+
+def compress(data, coding, level=DEFAULT_LEVEL):
+    c = zlib.compressobj(level, zlib.DEFLATED, WBITS[coding])
+    return c.compress(data) + c.flush()
+
+
+class Compressor(object):
+    """
+    Compresses response bodies for one configuration, with a cache of the
+    compressed bodies shared by every coding.
+    """
+    def __init__(self, min_size=DEFAULT_MIN_SIZE, level=DEFAULT_LEVEL,
+      cache_entries=DEFAULT_CACHE_ENTRIES, cache_bytes=DEFAULT_CACHE_BYTES):
+        self.min_size = int(min_size)
+        self.level = int(level)
+        self.cache_entries = int(cache_entries)
+        self.cache_bytes = int(cache_bytes)
+        self.cache = collections.OrderedDict()   # (digest, coding) -> body
+        self.cache_size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def encode(self, data, accept_encoding):
+        """
+        Returns (body, coding), coding is None when the body is sent as is.
+        The lock only covers the cache, compression runs outside of it.
+        """
+        if type(data) == unicode:
+            data = data.encode('utf-8')
+        if type(data) != str or len(data) < self.min_size:
+            return (data, None)
+        coding = negotiate(accept_encoding)
+        if coding is None:
+            return (data, None)
+
+        key = (hashlib.md5(data).digest(), coding)
+        self.lock.acquire()
+        try:
+            body = self.cache.get(key)
+            if body is not None:
+                # most recently used entries live at the end
+                del self.cache[key]
+                self.cache[key] = body
+                self.hits += 1
+                self.bytes_in += len(data)
+                self.bytes_out += len(body)
+                return (body, coding)
+        finally:
+            self.lock.release()
+
+        body = compress(data, coding, self.level)
+        if len(body) >= len(data):
+            # incompressible, keep the original
+            body = data
+
+        self.lock.acquire()
+        try:
+            self.misses += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(body)
+            if key not in self.cache and len(body) <= self.cache_bytes:
+                self.cache[key] = body
+                self.cache_size += len(body)
+                while len(self.cache) > self.cache_entries or \
+                  self.cache_size > self.cache_bytes:
+                    self.cache_size -= len(self.cache.popitem(last=False)[1])
+        finally:
+            self.lock.release()
+
+        if body is data:
+            return (data, None)
+        return (body, coding)
+
+    def stats(self):
+        self.lock.acquire()
+        try:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'entries': len(self.cache),
+                'bytes_in': self.bytes_in,
+                'bytes_out': self.bytes_out
+            }
+        finally:
+            self.lock.release()
+
+
+def fromOptions(options):
+    "build a Compressor from a 'compress' setting or route option"
+    if not options:
+        return None
+    if options is True:
+        return Compressor()
+    opt = dict(options)
+    return Compressor(opt.get('min_size', DEFAULT_MIN_SIZE),
+        opt.get('level', DEFAULT_LEVEL),
+        opt.get('cache_entries', DEFAULT_CACHE_ENTRIES),
+        opt.get('cache_bytes', DEFAULT_CACHE_BYTES))
+
+
+def configure(options):
+    "set up the global compressor from the 'compress' setting"
+    global Default
+    Default = fromOptions(options)
+
+
+def applyEncoding(compressor, data, headers, accept_encoding):
+    """
+    Compress a 200 response body, returns (body, headers) with the headers
+    copied and updated (Content-Encoding, Vary and a weakened ETag).
+    """
+    if compressor is None or 'Content-Encoding' in headers:
+        return (data, headers)
+    headers = dict(headers)
+    headers['Vary'] = 'Accept-Encoding'
+    (body, coding) = compressor.encode(data, accept_encoding)
+    if coding is None:
+        return (body, headers)
+    headers['Content-Encoding'] = coding
+    etag = headers.get('ETag', None)
+    if etag and not etag.startswith('W/'):
+        # the encoded body is not byte for byte the tagged entity
+        headers['ETag'] = 'W/' + etag
+    return (body, headers)
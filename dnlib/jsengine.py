@@ -0,0 +1,190 @@
+"""
+The javascript engine behind dreadnought. Everything that creates a
+context, evaluates code or inspects javascript values goes through the
+engine returned by current(), current().eval(context, source) runs code:
+
+    pyv8     V8 through PyV8, the default
+
+The engine is picked with the DN_ENGINE environment variable, the
+--engine option of dreadnought.py or select(), before any context is
+created.
+
+pyv8 is the only engine that runs javascript. The python engine is a
+stand-in letting benchmarks and tests run without V8, selected with
+selectPython(): its callbacks are python callables and it evaluates
+nothing but simple call statements such as "var res = jscb(req);", so it
+is not offered by select().
+
+An engine creates contexts with enter(), leave(), eval(source) and a
+'locals' object holding the global variables, and usable in a with
+statement.
+"""
+import os
+import re
+
+
+try:
+    import PyV8
+    JSClass = PyV8.JSClass
+except ImportError:
+    PyV8 = None
+
+    class JSClass(object):
+        "base class of the python objects exposed to javascript"
+        def __init__(self):
+            pass
+
+
+class Engine(object):
+    "interface of a javascript engine"
+    name = None
+
+    def createContext(self, glob=None):
+        "new context whose global object is 'glob'"
+        raise NotImplementedError
+
+    def eval(self, context, source):
+        "evaluate 'source' in the entered context, returns its value"
+        return context.eval(source)
+
+    def call(self, context, func, *args):
+        "call a javascript function with python arguments"
+        return func(*args)
+
+    def toPython(self, value):
+        "dicts and lists for javascript objects and arrays, recursively"
+        if self.isObject(value) or type(value) == dict:
+            return dict([(k, self.toPython(v)) for (k, v) in dict(value).items()])
+        if self.isArray(value) or type(value) in (list, tuple):
+            return [self.toPython(v) for v in list(value)]
+        return value
+
+    def isObject(self, obj):
+        raise NotImplementedError
+
+    def isArray(self, obj):
+        raise NotImplementedError
+
+    def isFunction(self, obj):
+        raise NotImplementedError
+
+    def isNull(self, obj):
+        raise NotImplementedError
+
+    def isUndefined(self, obj):
+        raise NotImplementedError
+
+
+class PyV8Engine(Engine):
+    name = 'pyv8'
+
+    def __init__(self):
+        if PyV8 is None:
+            raise ImportError, \
+                "PyV8 is not installed"
+
+    def createContext(self, glob=None):
+        return PyV8.JSContext(glob)
+
+    # PyV8 value types are told apart by name, as the handler api always did
+    def _is(self, obj, name):
+        return str(type(obj)).find(name) != -1
+
+    def isObject(self, obj):    return self._is(obj, 'PyV8.JSObject')
+    def isArray(self, obj):     return self._is(obj, 'PyV8.JSArray')
+    def isFunction(self, obj):  return self._is(obj, 'PyV8.JSFunction')
+    def isNull(self, obj):      return self._is(obj, 'PyV8.JSNULL')
+    def isUndefined(self, obj): return self._is(obj, 'PyV8.JSUndefined')
+
+
+# var <name> = <function>(<arg>,...);
+_CALL = re.compile(r'^\s*var\s+(\w+)\s*=\s*(\w+)\(([\w\s,]*)\);?\s*$')
+
+
+class _Locals(object):
+    pass
+
+
+class PythonContext(object):
+    "context of the python engine, globals are attributes of 'locals'"
+    def __init__(self, glob=None):
+        self.glob = glob
+        self.locals = _Locals()
+        self.depth = 0
+
+    def enter(self):
+        self.depth += 1
+
+    def leave(self):
+        self.depth -= 1
+
+    def __enter__(self):
+        self.enter()
+        return self
+
+    def __exit__(self, *exc):
+        self.leave()
+
+    def _lookup(self, name):
+        if hasattr(self.locals, name):
+            return getattr(self.locals, name)
+        return getattr(self.glob, name)
+
+    def eval(self, source):
+        m = _CALL.match(source)
+        if m is None:
+            raise NotImplementedError, \
+                "the python engine can not evaluate %r" % source[:80]
+        (var, func, args) = m.groups()
+        args = [self._lookup(a.strip()) for a in args.split(',') if a.strip()]
+        value = self._lookup(func)(*args)
+        setattr(self.locals, var, value)
+        return value
+
+
+class PythonEngine(Engine):
+    name = 'python'
+
+    def createContext(self, glob=None):
+        return PythonContext(glob)
+
+    def isObject(self, obj):    return type(obj) == dict
+    def isArray(self, obj):     return type(obj) in (list, tuple)
+    def isFunction(self, obj):  return callable(obj)
+    def isNull(self, obj):      return obj is None
+    def isUndefined(self, obj): return False
+
+
+# engines able to run user scripts
+Engines = {
+    'pyv8': PyV8Engine
+}
+
+_current = None
+
+
+def select(name):
+    "use engine 'name' from now on"
+    global _current
+    if name == PythonEngine.name:
+        raise ValueError, \
+            "the python engine only runs benchmarks and tests, not scripts"
+    if name not in Engines:
+        raise ValueError, \
+            "engine must be one of %s" % ",".join(sorted(Engines.keys()))
+    _current = Engines[name]()
+    return _current
+
+
+def selectPython():
+    "use the python engine from now on, for benchmarks and tests only"
+    global _current
+    _current = PythonEngine()
+    return _current
+
+
+def current():
+    "the engine in use, DN_ENGINE or pyv8 unless select() was called"
+    if _current is None:
+        select(os.environ.get('DN_ENGINE', 'pyv8'))
+    return _current
@@ -1,105 +1,129 @@
-import PyV8
+import jsengine
 import os
 import traceback
-try:
-    import cPickle as pickle
-except:
-    import pickle
 import threading
+import collections
+import time
 import logging
 import select
-import tempfile
-import struct
+import socket
+import signal
+import errno
+import fcntl
+import random
 import jsapi
-from jslogging import PipeLogger
+import jscache
+import shmring
+import wirecodec
+import jslogging
+import jsprofile
+import jsmemory
+from jslogging import RouteLogger
+
+# pass file descriptors over a unix socket (SCM_RIGHTS), python 2 has
+# no socket.sendmsg so use the helpers multiprocessing is built on.
+from _multiprocessing import sendfd, recvfd
+
+
+def _close_fd(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
+
+
+def _reinit_logging_locks():
+    # A thread of the parent may hold a logging lock at the time of the
+    # fork, python 2 does not reset them in the child which would then
+    # deadlock on its first log message.
+    logging._lock = threading.RLock()
+    for ref in logging._handlerList:
+        handler = ref()
+        if handler:
+            handler.createLock()
+    # the log drain thread of the parent is not running in the child
+    jslogging.Drain.forget()
 
 
 class IOChannel(object):
     """ Interprocess communication using a pipe to exchange serialized python objects
         between a child process and the main process running cherrypy.
     """
-    def __init__(self):
+    def __init__(self, codec=wirecodec.DEFAULT_CODEC):
         self.r, self.w = os.pipe()
-
-        self.reader = os.fdopen( self.r, "r" )
-        self.writer = os.fdopen( self.w, "w" )
+        self.codec = wirecodec.getCodec(codec)
 
     def fileno(self):
         return self.r
 
     def recv(self):
         "un-serialize an incoming object"
-        return pickle.load(self.reader)
+        return wirecodec.recv_frame(self.r, self.codec)
 
     def send(self, obj):
         "serialize and send an object"
-        pickle.dump(obj, self.writer)
-        self.writer.flush()
+        wirecodec.send_frame(self.w, self.codec, obj)
 
+    def fds(self):
+        "file descriptors still open"
+        return [fd for fd in (self.r, self.w) if fd is not None]
 
+    def close_read(self):
+        if self.r is not None:
+            _close_fd(self.r)
+            self.r = None
 
-class NpWriter:
-    "Manage the writing side of a named pipe"
-    def __init__(self,fn):
-        self.fn = fn 
-        self.f = open(fn,'w')
-        self.lock = threading.RLock()
+    def close_write(self):
+        if self.w is not None:
+            _close_fd(self.w)
+            self.w = None
 
-    def send(self, obj): 
-        data = pickle.dumps(obj)
-        hdr = struct.pack('>i', len(data))
-        self.lock.acquire()
-        self.f.write(hdr+data)
-        self.f.flush()
-        self.lock.release()
+    def close(self):
+        self.close_read()
+        self.close_write()
 
 
 
-class NpReader:
-    "Manage the reading side of a named pipe"
-    def __init__(self, fn):
-        self.f = open(fn,'r')
-        self.fn = fn
+class SocketChannel(object):
+    """ One end of a unix socketpair. Unlike a pipe it carries objects both
+        ways so the same channel serves as request and response channel of
+        an overflow handler.
+    """
+    def __init__(self, sock, codec=wirecodec.DEFAULT_CODEC):
+        self.sock = sock
+        self.codec = wirecodec.getCodec(codec)
+        self.closed = False
 
     def fileno(self):
-        return self.f.fileno()
-
-    def _read_bytes(self, n):
-        buf = ''
-        while len(buf) < n:
-            t = n - len(buf)
-            buf += self.f.read(t)
-            return buf
+        return self.sock.fileno()
 
-    def __del__(self):
-        self.f.close()
-        os.remove( self.fn )
+    def fds(self):
+        "file descriptors still open"
+        if self.closed:
+            return []
+        return [self.sock.fileno()]
 
     def recv(self):
-        hdr = self._read_bytes(struct.calcsize('i'))
-        size = struct.unpack(">i",hdr)[0]
-        data = self._read_bytes(size)
-        return pickle.loads(data)
-
+        "un-serialize an incoming object"
+        return wirecodec.recv_frame(self.sock.fileno(), self.codec)
 
-class NamedPipeFactory:
-    """ Replaces IOChannel if processes are forked on demand
-    """
+    def send(self, obj):
+        "serialize and send an object"
+        wirecodec.send_frame(self.sock.fileno(), self.codec, obj)
 
-    def __init__(self):
-        fd, self.filename = tempfile.mkstemp()
-        os.close(fd)
-        if os.access(self.filename,os.F_OK):
-            os.remove(self.filename)
-        os.mkfifo(self.filename)
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
 
-    def getWriter(self):
-        return NpWriter( self.filename ) 
 
-    def getReader(self):
-        return NpReader(self.filename)
+# transports selectable with the 'ipc' setting, each one creates a
+# channel exchanging objects between cherrypy and a child process.
+Transports = {
+    'pipe': IOChannel,
+    'shm' : shmring.ShmChannel
+}
 
-        
 
 
 
@@ -112,7 +136,7 @@ JsCbLookup = []
 def AddJsCb( path, jscb, options ):
 
     # create a logger for this callback
-    logger = PipeLogger( "[%s]%s" % (options.get('method','http'), path) )
+    logger = RouteLogger( "[%s]%s" % (options.get('method','http'), path) )
 
     # get optional callback user arguments
     jsargs = options.get('userdata',None)
@@ -123,31 +147,125 @@ def AddJsCb( path, jscb, options ):
     return r
 
 
-       
+# chunks a push streaming callback may write ahead of the parent
+STREAM_WINDOW = 16
+
+# fraction below max_requests the request limit of a process may be drawn
+RECYCLE_JITTER = 0.2
+
+
+class RequestTimeout(RuntimeError):
+    "a request ran past the timeout of its route"
+    pass
+
+
+class _Pending(object):
+    "A request sent to a child process waiting for its reply"
+    def __init__(self, callback=None, on_chunk=None):
+        self.callback = callback
+        self.on_chunk = on_chunk
+        self.res = None
+        self.chunks = collections.deque()
+        self.started = time.time()
+        self.sent = None
+        # 'timeout' option of the route, None for the pool default
+        self.timeout = None
+        self.stream = False
+
+    def limit(self, default):
+        "seconds the request may run, 0 for no limit"
+        if self.timeout is not None:
+            return self.timeout
+        if self.stream:
+            # streams run as long as they have data, unless the route says
+            return 0
+        return default
+
+    def ready(self):
+        return self.res is not None or len(self.chunks) > 0
+
+
+class _PushWriter(jsengine.JSClass):
+    """
+    Passed to push streaming callbacks, each write() sends a chunk to the
+    parent right away. The parent hands out credit for 'window' chunks and
+    returns it as the chunks are consumed, write() blocks without credit.
+    """
+    def __init__(self, jsh, rid, window):
+        jsengine.JSClass.__init__(self)
+        self.jsh = jsh
+        self.rid = rid
+        self.credit = window
+
+    def write(self, data):
+        if data is None or len(data) == 0:
+            return
+        while self.credit <= 0:
+            self.credit += self.jsh._wait_credit( self.rid )
+        self.credit -= 1
+        self.jsh.res_chan.send({'rid': self.rid, 'chunk': data})
+
 
 class JSHandler(object):
     """ This object represents the child process that handles incoming 
         web requests and sends responses back to cherrypy. 
     """
 
-    def __init__(self, api, np_channels=None, set_context=True):
+    def __init__(self, api, np_channels=None, set_context=True, ipc='pipe',
+      codec=wirecodec.DEFAULT_CODEC):
         if set_context:
-            self.context = PyV8.JSContext( api )
+            self.context = jsengine.current().createContext( api )
+
+        # set up by start() once the child process exists
+        self.pid = None
+        self.fault_detector = None
 
         if not np_channels:
-            self.fault_detector = select.poll() 
-            self.req_chan = IOChannel()
-            self.res_chan = IOChannel()
-        
-            # used to detect a terminated child process
-            error = select.POLLNVAL | select.POLLERR | select.POLLHUP
-            self.fault_detector.register( self.req_chan.fileno(), error )
-            self.fault_detector.register( self.res_chan.fileno(), error )
+            self.req_chan = Transports[ipc]( codec )
+            self.res_chan = Transports[ipc]( codec )
         else:
             self.req_chan, self.res_chan = np_channels
-            self.fault_detector = None # Not needed since this process dies after 
-                                       # after the request is complete
-        self.lock = threading.RLock()
+            # No fault detector needed since this process dies after 
+            # after the request is complete
+
+        # route loggers of the child send their records over this channel
+        (self.log_r, self.log_w) = (None, None)
+        if not np_channels:
+            (self.log_r, self.log_w) = jslogging.channelPair()
+
+        # requests in flight keyed by request id
+        self.pending = {}
+        self.next_rid = 0
+        self.reading = False
+        self.cond = threading.Condition()
+        self.send_lock = threading.Lock()
+
+        # child side, requests read while a push stream waited for credit
+        self.backlog = collections.deque()
+        # spans of the request being traced in the child
+        self.spans = None
+        # child side, logger handed to the callbacks of each route
+        self.loggers = {}
+        # default timeout checked by the waiting thread itself, for overflow
+        # handlers which have no supervisor
+        self.local_timeout = None
+        self.timed_out = False
+        # overflow handlers, called once a spare process adopts the request
+        self.on_adopt = None
+
+    def close(self):
+        "release the pipes of a child process that has been retired"
+        self.req_chan.close()
+        self.res_chan.close()
+        if self.log_r is not None:
+            jslogging.Drain.remove( self.log_r )
+            self.log_r.close()
+            self.log_r = None
+
+    def fds(self):
+        "file descriptors of the pipes held by this process"
+        return self.req_chan.fds() + self.res_chan.fds() + \
+            [s.fileno() for s in (self.log_r, self.log_w) if s is not None]
 
     def detectChildFault(self):
         result = False
@@ -155,119 +273,499 @@ class JSHandler(object):
             result = len(self.fault_detector.poll(0)) > 0
         return result
 
-    def start(self):
+    def expired(self, default=0):
+        """
+        Requests in flight that ran past their timeout, 'default' applies to
+        routes without a 'timeout' option. Returns (expired, seconds until
+        the next one expires or None).
+        """
+        now = time.time()
+        expired = []
+        soonest = None
+        self.cond.acquire()
+        try:
+            for pending in self.pending.values():
+                limit = pending.limit( default )
+                if not limit:
+                    continue
+                left = pending.started + limit - now
+                if left <= 0:
+                    expired.append( pending )
+                elif soonest is None or left < soonest:
+                    soonest = left
+        finally:
+            self.cond.release()
+        return (expired, soonest)
+
+    def oldest_pending(self):
+        "seconds the oldest request in flight has been waiting, 0 if none"
+        self.cond.acquire()
+        try:
+            if not self.pending:
+                return 0
+            return time.time() - min([p.started for p in self.pending.values()])
+        finally:
+            self.cond.release()
+
+    def start(self, inherited=()):
+        """
+        Fork the child process, the parent reaps it with waitpid(self.pid).
+        'inherited' lists file descriptors the child gets from the parent
+        but must not hold, such as the pipes of the other children. Each
+        end of a pipe is then open in exactly one process so the death of
+        either side shows up as a hangup on the other.
+        """
         pid = os.fork()
         if pid == 0:
-            # double fork to prevent potential zombie processes.
-            if os.fork() == 0:
+            try:
+                _reinit_logging_locks()
+                signal.signal( signal.SIGCHLD, signal.SIG_DFL )
+                own = self.fds()
+                for fd in inherited:
+                    if fd not in own:
+                        _close_fd(fd)
+                self.req_chan.close_write()
+                self.res_chan.close_read()
+                self.log_r.close()
+                jslogging.Channel.attach( self.log_w )
                 self.run()
                 logging.info("child process exiting")
-
-            # both child and grandchild terminate here.  
+            except:
+                logging.error( traceback.format_exc() )
             os._exit(0)
 
+        self.pid = pid
+        self.req_chan.close_read()
+        self.res_chan.close_write()
+        self.log_w.close()
+        self.log_w = None
+        jslogging.Drain.add( self.log_r )
+
+        # used to detect a terminated child process
+        self.fault_detector = select.poll()
+        self.fault_detector.register( self.res_chan.fileno(),
+            select.POLLNVAL | select.POLLERR | select.POLLHUP )
+
     def transaction(self, req):
         # Send a request to the javascript callback, return the response along with
-        # extra options associated with this callback.
+        # extra options associated with this callback. Several threads may have
+        # transactions in flight on the same child, replies are matched to
+        # requests by their request id.
 
-
-        self.lock.acquire()
         try:
-            (jscb, jsargs, logger, options) = JsCbLookup[ req['ident'] ]
-            res  = self._transaction(logger, req)
+            res  = self._transaction(req)
         except:
             res = {'exc': traceback.format_exc() }
-        self.lock.release()
 
         if "exc" in res:
+            if res.get('status',None) == 504:
+                raise RequestTimeout, res['exc']
             raise RuntimeError, res['exc']
         return res
 
 
-    def _transaction(self, logger, req):
-        p = select.poll()
-        p.register( logger.fileno(), select.POLLIN )
-        p.register( self.res_chan.fileno(), select.POLLIN )
+    def _send(self, req, pending):
+        "assign a request id to req and send it to the child"
+        options = JsCbLookup[ req['ident'] ][3]
+        pending.timeout = options.get('timeout',None)
+        pending.stream = bool(options.get('stream',False))
 
-        self.req_chan.send( req )
-        while True:
-            for (fd,evt) in p.poll(-1):
-                if logger.fileno() == fd and evt & select.POLLIN:
-                    # Note: root logger is configured as a passthrough with no
-                    # formatting except %(message)s, this allows it to be a 
-                    # collection point for the route loggers.
-                    logging.info(logger.read()[:-1])
+        self.cond.acquire()
+        rid = self.next_rid
+        self.next_rid += 1
+        self.pending[rid] = pending
+        self.cond.release()
+
+        req['rid'] = rid
+        start = time.time()
+        self.send_lock.acquire()
+        try:
+            self.req_chan.send( req )
+            if req.get('trace',False):
+                pending.sent = (start, time.time())
+        except:
+            self.cond.acquire()
+            del self.pending[rid]
+            self.cond.release()
+            raise
+        finally:
+            self.send_lock.release()
+
+    def submit(self, req, callback, on_chunk=None, window=STREAM_WINDOW):
+        """
+        Send a request without waiting for the reply, used by an event loop
+        that owns the response pipe. callback(res) is invoked from read_reply()
+        once the reply arrives.
 
-                elif self.res_chan.fileno() == fd and evt & select.POLLIN:
+        With on_chunk the request runs as a push stream, on_chunk(data) is
+        invoked for every chunk and credit must be returned with grant().
+        Returns the request id.
+        """
+        if on_chunk:
+            req['push'] = window
+        self._send( req, _Pending(callback, on_chunk) )
+        return req['rid']
 
-                    # completed transaction
-                    res = self.res_chan.recv()
-                    return res
+    def stream(self, req, window=STREAM_WINDOW):
+        """
+        Run a push streaming callback and yield the chunks it writes as they
+        arrive. Credit goes back to the child in batches of half the window
+        as chunks are consumed, closing the generator early cancels the
+        callback.
+        """
+        pending = _Pending()
+        req['push'] = window
+        self._send( req, pending )
+        rid = req['rid']
 
+        consumed = 0
+        try:
+            while pending.res is None or pending.chunks:
+                self._wait( pending )
+                while pending.chunks:
+                    yield pending.chunks.popleft()
+                    consumed += 1
+                    if consumed >= max(1, window / 2) and pending.res is None:
+                        self.grant( rid, consumed )
+                        consumed = 0
+        finally:
+            if pending.res is None:
+                try:
+                    self._control({'rid': rid, 'cancel': True})
+                except:
+                    logging.warning( traceback.format_exc() )
+
+        res = pending.res
+        if 'exc' in res:
+            raise RuntimeError, res['exc']
+        if 'error' in res:
+            raise RuntimeError, res['error']
+
+    def grant(self, rid, n):
+        "return credit for n chunks to a push stream"
+        self._control({'rid': rid, 'credit': n})
+
+    def cancel(self, rid):
+        "make the next write() of a push stream fail"
+        self._control({'rid': rid, 'cancel': True})
+
+    def _control(self, msg):
+        self.send_lock.acquire()
+        try:
+            self.req_chan.send( msg )
+        finally:
+            self.send_lock.release()
+
+    def read_reply(self):
+        "read one reply from the child and hand it to whoever waits for it"
+        res = self.res_chan.recv()
+        rid = res.pop('rid',None)
+        if 'spare_pid' in res:
+            # an overflow process adopted the request
+            self.pid = res['spare_pid']
+            if self.on_adopt:
+                self.on_adopt()
+        elif 'chunk' in res:
+            self._chunk( rid, res['chunk'] )
+        else:
+            self._complete( rid, res )
+
+    def _transaction(self, req):
+        pending = _Pending()
+        self._send( req, pending )
+        self._wait( pending )
+        return pending.res
+
+    def _wait(self, pending):
+        # only one thread at a time reads from the response pipe, it hands
+        # out replies belonging to other threads as they arrive.
+        self.cond.acquire()
+        try:
+            while not pending.ready():
+                if self.reading:
+                    self.cond.wait()
+                else:
+                    self.reading = True
+                    self.cond.release()
+                    try:
+                        self._read_replies( pending )
+                    finally:
+                        self.cond.acquire()
+                        self.reading = False
+                        self.cond.notify_all()
+        finally:
+            self.cond.release()
+
+
+    def _read_replies(self, pending):
+        # read replies until the one for 'pending' arrives, log records of
+        # the child are drained by jslogging.Drain.
+        p = select.poll()
+        p.register( self.res_chan.fileno(), select.POLLIN )
+        while not pending.ready():
+            # wake up periodically to check local timeouts
+            try:
+                events = p.poll(100)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    # SIGCHLD from the supervisor
+                    continue
+                raise
+            for (fd,evt) in events:
+                if evt & select.POLLIN:
+                    # completed transaction
+                    self.read_reply()
                 else:
                     # unexpected error, we should never get this but we
                     # need to handle it anyway.
-                    n = {
-                        logger.fileno(): 'logger',
-                        self.res_chan.fileno(): 'response_pipe'
-                    }
-                    return {"exc": "%s error event=%x" % ( n[fd], evt )}
-
-
-    def _handle_streaming(self, req):
-        # streaming request controls the context and calls this
-        # processes over and over until done.
-        if req.get('start-streaming',False):
-            self.context.enter()
-            return {
-                'success': True
-            }
-        elif req.get('end-streaming',False):
-            self.context.leave()
-            return {
-                'success': True
-            }
-        else:
-            return self._jsexec( req )
+                    self._fail_pending( "response_pipe error event=%x" % evt )
+                    return
+            if self.local_timeout is not None and not pending.ready():
+                (expired, left) = self.expired( self.local_timeout )
+                if expired:
+                    self._expire( expired )
+                    return
+
+    def _expire(self, expired):
+        # an overflow process ran a request past its timeout, kill it like
+        # the supervisor kills a pool process, the overflow controller
+        # reaps it.
+        msg = "js overflow process %s ran a request past its timeout" % self.pid
+        logging.error( msg + ", killing it" )
+        self.timed_out = True
+        if self.pid:
+            try:
+                os.kill( self.pid, signal.SIGKILL )
+            except OSError:
+                pass
+        self._fail_pending( msg, expired )
+
+    def _complete(self, rid, res):
+        self.cond.acquire()
+        pending = self.pending.pop( rid, None )
+        if pending and pending.sent and '_trace' in res:
+            res['_trace']['send'] = pending.sent
+            res['_trace']['received'] = time.time()
+        if pending:
+            pending.res = res
+            self.cond.notify_all()
+        self.cond.release()
+
+        if pending and pending.callback:
+            pending.callback( res )
+
+    def _chunk(self, rid, data):
+        self.cond.acquire()
+        pending = self.pending.get( rid )
+        if pending and not pending.on_chunk:
+            pending.chunks.append( data )
+            self.cond.notify_all()
+        self.cond.release()
+
+        if pending and pending.on_chunk:
+            pending.on_chunk( data )
+
+    def _fail_pending(self, msg, expired=()):
+        "fail every transaction in flight, those in 'expired' with a 504"
+        self.cond.acquire()
+        failed = self.pending.values()
+        for pending in failed:
+            pending.res = {"exc": msg}
+            if pending in expired:
+                pending.res['status'] = 504
+        self.pending.clear()
+        self.cond.notify_all()
+        self.cond.release()
+
+        for pending in failed:
+            if pending.callback:
+                pending.callback( pending.res )
+
 
     def _jsexec( self, req ):
-        # execute javascript command
-        (jscb, jsargs, pipe_logger, options) = JsCbLookup[ req['ident'] ]
- 
-
-        self.context.locals.jscb = jscb 
-        self.context.locals.jsargs = jsargs
-        self.context.locals.logger = pipe_logger.getLogger() #pipe_logger.logger
-        self.context.locals.req = req
-        self.context.eval("var res = jscb(logger,req,jsargs);")
-        return dict(self.context.locals.res) 
+        # execute javascript command, the callback is called directly so
+        # nothing is parsed or compiled per request and the globals of the
+        # context are left alone.
+        ident = req['ident']
+        (jscb, jsargs, route_logger, options) = JsCbLookup[ ident ]
+        logger = self.loggers.get( ident )
+        if logger is None:
+            logger = self.loggers[ ident ] = route_logger.getLogger()
+
+        etag = None
+        if options.get('version',None) and 'push' not in req \
+          and not req.get('streaming',False):
+            start = time.time()
+            etag = self._version( options['version'], req, jsargs )
+            self._span( 'version', start )
+            if jscache.etagMatches( req.get('if_none_match',None), etag ):
+                # the client is up to date, skip the handler
+                return {'not_modified': True, 'etag': etag}
+
+        engine = jsengine.current()
+        if 'push' in req:
+            # push streaming, the callback gets a writer for its chunks
+            out = _PushWriter( self, req['rid'], req['push'] )
+            res = engine.call( self.context, jscb, logger, req, jsargs, out )
+        else:
+            start = time.time()
+            res = engine.call( self.context, jscb, logger, req, jsargs )
+            self._span( 'js call', start )
+        start = time.time()
+        res = dict(res or {})
+        self._span( 'result conversion', start )
+        if etag and not res.get('etag',None):
+            res['etag'] = etag
+        return res
+
+    def _span(self, name, start):
+        # time a stage of a traced request
+        if self.spans is not None:
+            self.spans.append( (name, start, time.time()) )
+
+    def _version(self, vcb, req, jsargs):
+        # cheap callback returning the version of the resource, it becomes
+        # the entity tag of the response.
+        return jscache.quoteETag( jsengine.current().call( self.context,
+            vcb, req, jsargs ) )
+
+    def _wait_credit(self, rid):
+        # Read the request channel until credit for push stream 'rid' shows
+        # up, other requests are kept for the run loop.
+        while True:
+            msg = self.req_chan.recv()
+            if msg.get('rid') == rid and 'credit' in msg:
+                return msg['credit']
+            if msg.get('rid') == rid and 'cancel' in msg:
+                raise IOError, "push stream cancelled"
+            self.backlog.append( msg )
          
 
     def run(self):
+        jsprofile.childInit()
+        jsmemory.childInit()
+        # the process only ever runs this context, it stays entered for
+        # the life of the process instead of around every request.
+        self.context.enter()
+        try:
+            self._serve()
+        finally:
+            self.context.leave()
+            jslogging.Channel.flush()
+
+    def _end_request(self):
+        # per request state of the process, nothing of a request is kept
+        # in the context since callbacks are called directly.
+        if self.spans is not None:
+            self.spans = None
+            jslogging.LogSpans = None
+        jsprofile.setRoute( None )
+        jsprofile.flushIfDue()
+        # the records logged by the request go to the parent in one batch
+        jslogging.Channel.flush()
+
+    def _serve(self):
         p = select.poll()
         p.register(self.req_chan.fileno(), select.POLLIN)
         while True:
-            # detect a pipe closure
-            for (fd,evt) in p.poll(-1):
-                if (evt & select.POLLIN) == 0:
-                    # exit run loop, kill process
-                    return
-
+            if not self.backlog:
+                # detect a pipe closure
+                try:
+                    events = p.poll(-1)
+                except select.error, e:
+                    if e.args[0] == errno.EINTR:
+                        # an idle process turned off by SIGUSR2 writes its
+                        # profile here, outside of the signal handler
+                        jsprofile.flushIfDue()
+                        continue
+                    raise
+                for (fd,evt) in events:
+                    if (evt & select.POLLIN) == 0:
+                        # exit run loop, kill process
+                        return
+
+            rid = None
+            start = time.time()
             try:
-                req = self.req_chan.recv()
-                if req.get('streaming',False):
-                    res = self._handle_streaming( req )
-                else:                  
-                    self.context.enter()
-                    res = self._jsexec( req )
-                    self.context.leave()
+                try:
+                    if self.backlog:
+                        req = self.backlog.popleft()
+                    else:
+                        req = self.req_chan.recv()
+                except EOFError:
+                    # the other side closed the channel
+                    return
+                if req.get('retire',False):
+                    # the parent took this process out of the pool
+                    return
+                if 'credit' in req or 'cancel' in req:
+                    # flow control for a push stream that already ended
+                    continue
+                rid = req.get('rid',None)
+                if jsprofile.Active and 'ident' in req:
+                    jsprofile.setRoute( JsCbLookup[req['ident']][2].logger.name )
+                if req.get('trace',False):
+                    self.spans = [('receive', start, time.time())]
+                    jslogging.LogSpans = self.spans
+                start = time.time()
+                res = self._jsexec( req )
+                # reported to the parent for its metrics
+                res['_js_time'] = time.time() - start
             except:
                 res = {"exc": traceback.format_exc() }
 
+            if self.spans is not None:
+                res['_trace'] = {'pid': os.getpid(), 'rid': rid,
+                    'spans': self.spans, 'sent': time.time()}
+
+            # echo the request id so the parent can match the reply
+            res['rid'] = rid
             self.res_chan.send( res )
+            self._end_request()
 
 
 
+class _WaitStats(object):
+    "count, mean and maximum of the time requests waited for a handler"
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def report(self):
+        return {
+            'count': self.count,
+            'avg_ms': 1000.0 * self.total / max(self.count,1),
+            'max_ms': 1000.0 * self.max
+        }
+
+
+def _reap_children():
+    "reap every child process that has exited"
+    while True:
+        try:
+            if os.waitpid( -1, os.WNOHANG )[0] == 0:
+                return
+        except OSError:
+            return
+
+
+def _exited(pid):
+    "reap pid if it has exited, True if it is gone"
+    try:
+        return os.waitpid( pid, os.WNOHANG )[0] != 0
+    except OSError, e:
+        if e.errno == errno.EINTR:
+            return False
+        # ECHILD, already reaped
+        return True
+
+
 class JsHandlerControl:
     """
     Creates an array of child process handlers for all HTTP requests in the system.
@@ -281,131 +779,789 @@ class JsHandlerControl:
     def _overflow_handler_controller(self, api):
         """
         This process handles incoming http requests if no preforked processes are
-        available. It uses named pipes and forks on demand which is less efficient  
+        available. For each request it receives one end of a socketpair, to keep
+        latency down it holds 'overflow_spares' processes forked ahead of time
+        with a javascript context ready, each adopts one request and a new spare
+        is forked behind it.
         """  
+        spares = collections.deque()    # sockets handing a request to idle spares
         p = select.poll()
-        p.register( self.overflow_chan.fileno(), select.POLLIN )
+        p.register( self.overflow_peer.fileno(), select.POLLIN )
         hangup = False
         while not hangup:
-            for (fd,evt) in p.poll(-1):
+            while len(spares) < self.overflow_spares:
+                spares.append( self._fork_spare(api, spares) )
+            _reap_children()
+
+            for (fd,evt) in p.poll(1000):
                 if evt & select.POLLIN:
-                    npf_pair = self.overflow_chan.recv()
-                    if os.fork() == 0:
-                        if os.fork() == 0:
-                            # block until http handler creates the writer 
-                            req_chan = npf_pair[0].getReader()
-                            # block until the http handler creates the reader
-                            res_chan = npf_pair[1].getWriter()
-                            npipes = (req_chan,res_chan)
-                            try:
-                                # service http request using named pipes
-                                # for transit instead of anonymous pipes.
-                                JSHandler( api, npipes ).run()
-                            except:
-                                res_chan.send({
-                                    'exc': traceback.format_exc()
-                                })                               
-                        os._exit(0)
+                    try:
+                        conn = recvfd( self.overflow_peer.fileno() )
+                    except RuntimeError:
+                        # cherrypy process went away
+                        hangup = True
+                        break
+                    if spares:
+                        sock = spares.popleft()
+                    else:
+                        # burst larger than the spare pool, fork on demand
+                        sock = self._fork_spare(api, spares)
+                    try:
+                        sendfd( sock.fileno(), conn )
+                    except:
+                        logging.error( traceback.format_exc() )
+                    os.close( conn )
+                    sock.close()
                 else:
                     hangup = True  
 
+    def _fork_spare(self, api, spares):
+        "fork a spare process, returns the socket used to hand it a request"
+        (sock, peer) = socket.socketpair()
+        if os.fork() == 0:
+            try:
+                _reinit_logging_locks()
+                for other in spares:
+                    other.close()
+                self.overflow_peer.close()
+                sock.close()
+                self._overflow_spare(api, peer)
+            except:
+                logging.error( traceback.format_exc() )
+            os._exit(0)
+        peer.close()
+        return sock
+
+    def _overflow_spare(self, api, sock):
+        # create the context before any request shows up, that is the
+        # expensive part of starting a handler.
+        context = jsengine.current().createContext( api )
+        jslogging.Channel.attach( self.overflow_log_peer )
+        try:
+            fd = recvfd( sock.fileno() )
+        except RuntimeError:
+            # overflow controller went away
+            return
+        sock.close()
+
+        # service http request over the socketpair end sent by cherrypy
+        chan = SocketChannel( socket.fromfd(fd, socket.AF_UNIX,
+            socket.SOCK_STREAM), self.codec )
+        os.close( fd )
+        try:
+            # lets the parent kill this process when a request times out
+            chan.send({'spare_pid': os.getpid()})
+            jsh = JSHandler( api, (chan,chan), set_context=False )
+            jsh.context = context
+            jsh.run()
+        except:
+            chan.send({
+                'exc': traceback.format_exc()
+            })                               
+
     def _overflow_iface(self):
         idx = self.OVERFLOW_HANDLER_IDX
-        npf_pair = [ NamedPipeFactory(), NamedPipeFactory() ]
-                 
-        # send message to overflow control process, create a child process
-        # based on this named pipe pair, the child process will create the
-        # reader/writer compliments of the named pipes on the other end. 
-        self.overflow_chan.send( npf_pair )
- 
-        # block until child opens reader
-        req_chan = npf_pair[0].getWriter()
+        (sock, peer) = socket.socketpair()
 
-        # block until child opens writer
-        res_chan = npf_pair[1].getReader()
+        # pass one end to the overflow control process which hands it to a
+        # spare process, requests can be written right away, they wait in
+        # the socket buffer until the spare picks them up.
+        self.overflow_lock.acquire()
+        try:
+            sendfd( self.overflow_sock.fileno(), peer.fileno() )
+        finally:
+            self.overflow_lock.release()
+            peer.close()
 
-        jsh = JSHandler( self.api, (req_chan,res_chan), set_context=False )
+        chan = SocketChannel( sock, self.codec )
+        jsh = JSHandler( self.api, (chan,chan), set_context=False )
+        # the spare exits once it finds its socket closed by checkin(), or
+        # is killed by _expire() when a request runs past its timeout
+        jsh.local_timeout = self.timeout
 
         return (jsh,idx)         
 
     def __init__(self):
-        self.handlers = []
-        self.idx = 0
-        self.lock = threading.RLock()
-        self.overflow_chan = IOChannel()
+        self.handlers = []        # slot -> JSHandler
+        self.inflight = []        # slot -> requests in flight
+        self.last_used = []       # slot -> time of the last checkin
+        self.dead = set()         # slots whose child process died
+        self.retired = set()      # slots shrunk away by the autoscaler
+        # free[n] holds the slots with n requests in flight, each one an
+        # ordered set so slots are handed out round robin.
+        self.free = [ collections.OrderedDict() ]
+        self.waiting = 0
+        self.overflow_count = 0
+        self.overflow_spares = 2
+        # time requests served by a pre-forked process spent in checkout(),
+        # and requests served by the overflow handler until a spare process
+        # adopted them (forking one when none was left)
+        self.pool_wait = _WaitStats()
+        self.overflow_wait = _WaitStats()
+        self.lock = threading.Condition()
+        # socket ends for overflow requests go to the overflow controller
+        # through overflow_sock, the controller holds overflow_peer.
+        (self.overflow_sock, self.overflow_peer) = socket.socketpair()
+        # log channel shared by the overflow processes
+        (self.overflow_log, self.overflow_log_peer) = jslogging.channelPair()
+        self.overflow_lock = threading.Lock()
         self.api = None
-
-    def setup(self, api, cache_size):
+        self.ipc = 'pipe'
+        self.codec = wirecodec.DEFAULT_CODEC
+        self.pipeline = 1
+        self.wait_timeout = 0.1
+        self.queue_max = 100
+
+        # elastic sizing, see _autoscale()
+        self.pool_min = 0
+        self.pool_max = 0
+        self.scale_threshold = 0.8
+        self.idle_cooldown = 60.0
+        self.scale_up_count = 0
+        self.scale_down_count = 0
+        self.scale_log = collections.deque(maxlen=20)
+
+        # callables returning the length of request queues kept outside the
+        # pool (the async server), counted as waiting by the autoscaler.
+        self.queue_depth = []
+
+        # called as watcher(event, jsh) with event 'add' or 'remove' when the
+        # set of child processes changes. If any watcher is registered it
+        # owns closing removed handlers, and as watcher('fail', jsh, msg,
+        # expired) it owns failing the requests in flight on a process the
+        # supervisor replaces, from its own thread.
+        self.watchers = []
+
+        # callables returning file descriptors of the parent (sockets of the
+        # async server ...) that child processes forked later must close.
+        self.child_fds = []
+
+        # supervisor, see _supervise()
+        self.hang_timeout = 0
+        self.respawn_count = 0
+        self.timeout = 0
+        self.timeout_count = 0
+        self.next_expiry = None
+        self.exiting = set()      # pids of retired children not yet reaped
+        # a byte written to the wake pipe wakes the supervisor early, it is
+        # the only thing the SIGCHLD handler does: a lock taken there would
+        # deadlock the main thread if the signal arrived while it held it.
+        self.wake_r = None
+        self.wake_w = None
+
+        # recycling, see _recycle_due()
+        self.max_requests = 0
+        self.max_rss = 0
+        self.served = []          # slot -> requests served by its process
+        self.limits = []          # slot -> requests before it is recycled
+        self.recycling = set()    # slots draining before being recycled
+        self.recycle_count = 0
+
+    def setup(self, api, cache_size, ipc='pipe', codec=wirecodec.DEFAULT_CODEC,
+      pipeline=1, wait_timeout=0.1, queue_max=100, pool_min=None, pool_max=None,
+      scale_interval=1.0, scale_threshold=0.8, idle_cooldown=60.0,
+      supervise_interval=0.5, hang_timeout=0, overflow_spares=2,
+      max_requests=0, max_rss=0, timeout=0):
         """
         Setup an array of pre-forked processes to handle incoming requests
         along with a process to handle overflow conditions were we have to
         fork on demand.
+
+        :Parameters:
+        - `ipc`: transport used by the pre-forked processes, either 'pipe'
+                 (default) or 'shm' for shared memory ring buffers.
+        - `codec`: wire codec used to serialize requests and responses, one
+                   of 'binary' (default), 'marshal' or 'pickle'.
+        - `pipeline`: maximum number of requests in flight on one pre-forked
+                      process before falling back to the overflow handler.
+        - `wait_timeout`: seconds a request waits for a busy pre-forked
+                          process before it is sent to the overflow handler.
+        - `queue_max`: maximum number of requests waiting, once reached new
+                       requests go straight to the overflow handler.
+        - `pool_min`, `pool_max`: bounds of an elastic pool, when given the pool
+                       starts with pool_min processes and an autoscaler thread
+                       grows it up to pool_max under load.
+        - `scale_interval`: seconds between autoscaler decisions.
+        - `scale_threshold`: fraction of busy processes that triggers growth.
+        - `idle_cooldown`: seconds a process must sit idle before it is retired.
+        - `supervise_interval`: seconds between checks of the supervisor that
+                       replaces child processes which died.
+        - `hang_timeout`: seconds a request may run before its child process
+                       is considered hung, killed and replaced. 0 disables it.
+        - `overflow_spares`: processes the overflow handler keeps forked with
+                       a javascript context ready to adopt a request.
+        - `max_requests`: requests a process serves before it is replaced by
+                       a fresh one, 0 disables it. Each process gets a
+                       limit up to RECYCLE_JITTER below it so they do not
+                       all reach it together.
+        - `max_rss`: resident memory in bytes above which a process is
+                       replaced, 0 disables it.
+        - `timeout`: seconds a request may run for routes without a
+                       'timeout' option, streams excepted. A request past
+                       its timeout fails with a 504 and its process is
+                       killed and replaced. 0 disables it.
         """  
 
-        self.api = api
-        for i in range(0,cache_size):
-            jsh = JSHandler(api)
+        if ipc not in Transports:
+            raise ValueError, \
+                "ipc must be one of %s" % ",".join(sorted(Transports.keys()))
+        wirecodec.getCodec( codec )
 
-            # (handler, in_use)
-            self.handlers.append( (jsh,False) )
+        self.api = api
+        self.ipc = ipc
+        self.codec = codec
+        self.pipeline = max(1,int(pipeline))
+        self.wait_timeout = float(wait_timeout)
+        self.queue_max = int(queue_max)
+        self.free = [ collections.OrderedDict() for i in range(0,self.pipeline) ]
+
+        if pool_min is None and pool_max is None:
+            self.pool_min = self.pool_max = cache_size
+        else:
+            self.pool_min = int(pool_min or 0)
+            self.pool_max = max(self.pool_min, int(pool_max or cache_size))
+            cache_size = self.pool_min
+        self.scale_threshold = float(scale_threshold)
+        self.idle_cooldown = float(idle_cooldown)
+        self.hang_timeout = float(hang_timeout or 0)
+        self.overflow_spares = max(0,int(overflow_spares))
+        self.max_requests = int(max_requests or 0)
+        self.max_rss = int(max_rss or 0)
+        self.timeout = float(timeout or 0)
+
+        self.wake_r, self.wake_w = os.pipe()
+        for fd in (self.wake_r, self.wake_w):
+            fcntl.fcntl( fd, fcntl.F_SETFL,
+                fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK )
 
-            # start cheild process to service requests in javascript.
-            jsh.start()
+        for i in range(0,cache_size):
+            self._spawn()
 
         # launch child process to handle overflow conditions when we
         # have no spare processes to service a request
-        if os.fork() == 0:
+        pid = os.fork()
+        if pid == 0:
             if os.fork() == 0:
+                _reinit_logging_locks()
+                for jsh in self.handlers:
+                    jsh.close()
+                self.overflow_sock.close()
+                self.overflow_log.close()
                 self._overflow_handler_controller(api)
             os._exit(0)  
+        os.waitpid( pid, 0 )
+        self.overflow_peer.close()
+        self.overflow_peer = None
+        self.overflow_log_peer.close()
+        self.overflow_log_peer = None
+        jslogging.Drain.add( self.overflow_log )
+
+        if threading.current_thread().name == 'MainThread':
+            # signal handlers can only be installed from the main thread,
+            # elsewhere the supervisor relies on polling alone.
+            signal.signal( signal.SIGCHLD,
+                lambda signum, frame: self._wake() )
+            signal.siginterrupt( signal.SIGCHLD, False )
+
+        t = threading.Thread( target=self._supervise_loop,
+            args=(float(supervise_interval),), name="js-pool-supervisor" )
+        t.daemon = True
+        t.start()
+
+        if self.pool_max > self.pool_min:
+            t = threading.Thread( target=self._autoscale_loop,
+                args=(float(scale_interval),), name="js-pool-autoscaler" )
+            t.daemon = True
+            t.start()
+
+    def _spawn(self):
+        "fork a new child process and add it to the pool"
+        jsh = JSHandler(self.api, ipc=self.ipc, codec=self.codec)
+
+        # start child process to service requests in javascript.
+        jsh.start( self._inherited_fds() )
+        return self._add_handler( jsh )
+
+    def _inherited_fds(self):
+        "file descriptors of the parent a new child process must not keep"
+        self.lock.acquire()
+        try:
+            fds = [ s.fileno() for s in (self.overflow_sock, self.overflow_peer,
+                self.overflow_log, self.overflow_log_peer) if s ]
+            fds.extend( [fd for fd in (self.wake_r, self.wake_w) if fd is not None] )
+            fds.extend( jslogging.Drain.fds() )
+            for jsh in self.handlers:
+                fds.extend( jsh.fds() )
+        finally:
+            self.lock.release()
+        for f in self.child_fds:
+            fds.extend( f() )
+        return fds
 
+    def _add_handler(self, jsh):
+        "add a handler to the pool as an idle slot, reusing a retired slot"
+        self.lock.acquire()
+        try:
+            if self.retired:
+                idx = self.retired.pop()
+                self.handlers[idx] = jsh
+                self.inflight[idx] = 0
+                self.last_used[idx] = time.time()
+                self.served[idx] = 0
+                self.limits[idx] = self._request_limit()
+            else:
+                idx = len(self.handlers)
+                self.handlers.append( jsh )
+                self.inflight.append( 0 )
+                self.last_used.append( time.time() )
+                self.served.append( 0 )
+                self.limits.append( self._request_limit() )
+            self.free[0][idx] = True
+            self.lock.notify()
+        finally:
+            self.lock.release()
 
-    def checkout(self):
-        """
-        Return a preallocated javascript handler to service an incoming request. The js 
-        handler contains a child process which routes the request to a javascript
-        interpreter.
+        for watcher in self.watchers:
+            watcher('add', jsh)
+        return idx
+
+    def _retire(self, idx):
+        # Take an idle slot out of service, must hold the lock. Returns the
+        # handler to be shut down with _shutdown() once the lock is released.
+        self.free[0].pop( idx, None )
+        self.retired.add( idx )
+        return self.handlers[idx]
 
-        If no preforked processes are available then pass to the overflow handler which
-        will fork a handler on demand.
+    def _shutdown(self, jsh):
+        "tell a retired child process to exit and release its pipes"
+        try:
+            jsh.req_chan.send({'retire': True})
+        except:
+            logging.warning("unable to retire child process: %s" % \
+                traceback.format_exc())
+        if jsh.pid:
+            self.exiting.add( jsh.pid )
+        self._release( jsh )
+
+    def _fail(self, jsh, msg, expired=()):
+        "fail the requests in flight on a handler, through the watchers if any"
+        for watcher in self.watchers:
+            watcher('fail', jsh, msg, expired)
+        if not self.watchers:
+            jsh._fail_pending( msg, expired )
+
+    def _release(self, jsh):
+        "hand a handler taken out of the pool to the watchers or close it"
+        for watcher in self.watchers:
+            watcher('remove', jsh)
+        if not self.watchers:
+            jsh.close()
+
+    def _autoscale_loop(self, interval):
+        while True:
+            time.sleep( interval )
+            try:
+                self._autoscale()
+            except:
+                logging.error( traceback.format_exc() )
+
+    def _autoscale(self):
         """
+        One autoscaler decision. Grow when requests are waiting or the busy
+        fraction of live processes reaches scale_threshold, shrink by one
+        process at a time when a process has been idle for idle_cooldown.
+        """
+        now = time.time()
+        retire = None
+        grow = 0
 
         self.lock.acquire()
-        result = None
-        count = 0
-        while not result:
-            if count == len(self.handlers):
-                result = self._overflow_iface()
-            else:
-                (jsh,inuse) = self.handlers[self.idx]
-                if (not inuse) and (not jsh.detectChildFault()):
-                    result = (jsh,self.idx)
-                    self.handlers[self.idx] = (jsh,True)
-                 
-                self.idx = (self.idx + 1) % len(self.handlers) 
-                count += 1
-        self.lock.release()
+        try:
+            (live, busy) = self._counts()
+            waiting = self.waiting + sum([f() for f in self.queue_depth])
+            utilisation = float(busy) / max(live,1)
+
+            if live < self.pool_min:
+                grow = self.pool_min - live
+            elif live < self.pool_max and \
+              (waiting > 0 or utilisation >= self.scale_threshold):
+                grow = min(self.pool_max - live, max(1,waiting))
+            elif live > self.pool_min:
+                for idx in self.free[0].keys():
+                    if now - self.last_used[idx] >= self.idle_cooldown:
+                        retire = self._retire( idx )
+                        break
+        finally:
+            self.lock.release()
 
-        return result
+        if grow:
+            for i in range(0,grow):
+                self._spawn()
+            self._log_scale( "up", grow, live + grow, waiting, utilisation )
+        elif retire:
+            self._shutdown( retire )
+            self._log_scale( "down", 1, live - 1, waiting, utilisation )
+
+    def _log_scale(self, direction, n, size, waiting, utilisation):
+        if direction == "up":
+            self.scale_up_count += n
+        else:
+            self.scale_down_count += n
+        msg = "js pool scaled %s by %d to %d processes (waiting=%d utilisation=%.2f)" % \
+            ( direction, n, size, waiting, utilisation )
+        self.scale_log.append( (time.time(), msg) )
+        logging.info( msg )
+
+    def _wake(self):
+        "wake the supervisor early, safe to call from a signal handler"
+        if self.wake_w is None:
+            return
+        try:
+            os.write( self.wake_w, 'x' )
+        except OSError, e:
+            # a full pipe wakes the supervisor just the same
+            if e.errno != errno.EAGAIN:
+                raise
 
-    def checkin(self, jsh, idx):
-        if idx != self.OVERFLOW_HANDLER_IDX:
-            # check handler back into cache
-            self.lock.acquire()
-            self.handlers[self.idx] = (jsh,False)
+    def _supervise_loop(self, interval):
+        p = select.poll()
+        p.register( self.wake_r, select.POLLIN )
+        while True:
+            # woken early by SIGCHLD, by _take() finding a dead slot or when
+            # the next request in flight runs out of time
+            wait = interval
+            if self.next_expiry is not None:
+                wait = max(0.01, min(interval, self.next_expiry - time.time()))
+            try:
+                p.poll( wait * 1000 )
+                os.read( self.wake_r, 4096 )
+            except (select.error, OSError), e:
+                if e.args[0] not in (errno.EINTR, errno.EAGAIN):
+                    raise
+            try:
+                self._supervise()
+            except:
+                logging.error( traceback.format_exc() )
+
+    def _supervise(self):
+        """
+        Replace child processes that exited, closed their pipes, ran a
+        request past its timeout or, with a hang_timeout, sat on a request
+        for too long. Requests in flight on such a process fail right away,
+        those past their timeout with a 504, and the slot gets a fresh
+        process so the pool keeps its size. Then recycle processes over their request
+        or memory limit, see _recycle_due().
+        """
+        for pid in list(self.exiting):
+            if _exited( pid ):
+                self.exiting.discard( pid )
+
+        failed = []
+        soonest = None
+        self.lock.acquire()
+        try:
+            for (idx, jsh) in enumerate(self.handlers):
+                if idx in self.retired:
+                    continue
+                (expired, left) = jsh.expired( self.timeout )
+                if left is not None and (soonest is None or left < soonest):
+                    soonest = left
+                if idx in self.dead:
+                    reason = "died"
+                elif jsh.pid and _exited( jsh.pid ):
+                    reason = "exited"
+                elif jsh.detectChildFault():
+                    reason = "closed its pipe"
+                elif expired:
+                    reason = "ran a request past its timeout"
+                    self.timeout_count += len(expired)
+                elif self.hang_timeout and jsh.oldest_pending() > self.hang_timeout:
+                    reason = "hung"
+                else:
+                    continue
+                self._mark_dead( idx )
+                self.recycling.discard( idx )
+                failed.append( (idx, jsh, reason, expired) )
+        finally:
             self.lock.release()
+        self.next_expiry = soonest is not None and time.time() + soonest or None
+
+        for (idx, jsh, reason, expired) in failed:
+            msg = "js child process %s in slot %d %s" % (jsh.pid, idx, reason)
+            logging.error( msg + ", starting a replacement" )
+            if jsh.pid and not _exited( jsh.pid ):
+                try:
+                    os.kill( jsh.pid, signal.SIGKILL )
+                except OSError:
+                    pass
+                self.exiting.add( jsh.pid )
+            self._fail( jsh, msg, expired )
+            self._release( jsh )
+            self._respawn( idx )
+
+        if self.max_requests or self.max_rss:
+            self._recycle_due()
+
+    def _request_limit(self):
+        # requests the process of a new slot serves before it is recycled
+        if not self.max_requests:
+            return 0
+        return max(1, int(self.max_requests * \
+            (1.0 - random.random() * RECYCLE_JITTER)))
+
+    def _recycle_due(self):
+        """
+        Recycle processes that served their request limit or grew past
+        max_rss. One process at a time is taken out of the pool and, once
+        the requests it has in flight are done, replaced by a fresh fork
+        before it is told to exit, so the pool never recycles at once.
+        """
+        usage = {}
+        if self.max_rss:
+            for (idx, jsh) in enumerate(list(self.handlers)):
+                if jsh.pid and idx not in self.dead and idx not in self.retired:
+                    usage[idx] = jsmemory.rss( jsh.pid ) or 0
+
+        ready = None
+        self.lock.acquire()
+        try:
+            if not self.recycling:
+                candidates = []
+                for (idx, jsh) in enumerate(self.handlers):
+                    if idx in self.dead or idx in self.retired:
+                        continue
+                    if self.limits[idx] and self.served[idx] >= self.limits[idx]:
+                        candidates.append( (2, self.served[idx], idx,
+                            "served %d requests" % self.served[idx]) )
+                    elif self.max_rss and usage.get(idx,0) > self.max_rss:
+                        candidates.append( (1, usage[idx], idx,
+                            "uses %d bytes" % usage[idx]) )
+                if candidates:
+                    # request limits first, then the largest process
+                    (kind, n, idx, reason) = max(candidates)
+                    # stop handing the slot out, let its requests finish
+                    self.recycling.add( idx )
+                    for free in self.free:
+                        free.pop( idx, None )
+                    logging.info( "recycling js child process %s in slot %d, it %s" % \
+                        ( self.handlers[idx].pid, idx, reason ) )
+            for idx in self.recycling:
+                if self.inflight[idx] == 0:
+                    ready = idx
+        finally:
+            self.lock.release()
+
+        if ready is not None:
+            self._recycle( ready )
+            # look for the next one right away rather than next interval
+            self._wake()
 
+    def _recycle(self, idx):
+        "replace the idle process of a slot being recycled by a fresh one"
+        jsh = JSHandler(self.api, ipc=self.ipc, codec=self.codec)
+        jsh.start( self._inherited_fds() )
 
+        self.lock.acquire()
+        try:
+            old = self.handlers[idx]
+            self.handlers[idx] = jsh
+            self.inflight[idx] = 0
+            self.last_used[idx] = time.time()
+            self.served[idx] = 0
+            self.limits[idx] = self._request_limit()
+            self.recycling.discard( idx )
+            self.free[0][idx] = True
+            self.recycle_count += 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
 
+        for watcher in self.watchers:
+            watcher('add', jsh)
+        # the old process exits once it reads the retire message
+        self._shutdown( old )
 
+    def _mark_dead(self, idx):
+        # never hand this slot out again, must hold the lock
+        self.dead.add( idx )
+        for free in self.free:
+            free.pop( idx, None )
 
+    def _respawn(self, idx):
+        "start a new child process in the slot of one that died"
+        jsh = JSHandler(self.api, ipc=self.ipc, codec=self.codec)
+        jsh.start( self._inherited_fds() )
 
+        self.lock.acquire()
+        try:
+            self.handlers[idx] = jsh
+            self.inflight[idx] = 0
+            self.last_used[idx] = time.time()
+            self.served[idx] = 0
+            self.limits[idx] = self._request_limit()
+            self.dead.discard( idx )
+            self.free[0][idx] = True
+            self.respawn_count += 1
+            self.lock.notify()
+        finally:
+            self.lock.release()
 
+        for watcher in self.watchers:
+            watcher('add', jsh)
+
+    def _take(self):
+        # Pop the least loaded slot, idle ones first. A pre-forked process is
+        # shared by up to 'pipeline' requests in flight. Must hold the lock.
+        for level in range(0,self.pipeline):
+            free = self.free[level]
+            while free:
+                idx = free.popitem(last=False)[0]
+                if self.handlers[idx].detectChildFault():
+                    # child process died, the supervisor replaces it
+                    self._mark_dead( idx )
+                    self._wake()
+                    continue
+                self.inflight[idx] = level + 1
+                if level + 1 < self.pipeline:
+                    self.free[level+1][idx] = True
+                return (self.handlers[idx],idx)
+        return None
 
+    def checkout(self):
+        """
+        Return a preallocated javascript handler to service an incoming request. The js 
+        handler contains a child process which routes the request to a javascript
+        interpreter.
+
+        If every preforked process is busy wait up to wait_timeout for one to be
+        checked in, after that (or if too many requests are already waiting) pass
+        to the overflow handler which will fork a handler on demand.
+        """
 
+        start = time.time()
+        self.lock.acquire()
+        try:
+            result = self._take()
+            if result is None and self.waiting < self.queue_max:
+                deadline = time.time() + self.wait_timeout
+                self.waiting += 1
+                try:
+                    while result is None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            break
+                        self.lock.wait( remaining )
+                        result = self._take()
+                finally:
+                    self.waiting -= 1
+            if result is None:
+                self.overflow_count += 1
+            else:
+                self.pool_wait.add( time.time() - start )
+        finally:
+            self.lock.release()
 
+        if result:
+            return result
 
+        result = self._overflow_iface()
 
+        def adopted():
+            self.lock.acquire()
+            self.overflow_wait.add( time.time() - start )
+            self.lock.release()
+        result[0].on_adopt = adopted
+        return result
 
+    def try_checkout(self):
+        """
+        Like checkout but never waits or forks an overflow handler, returns None
+        if every preforked process is busy.
+        """
+        self.lock.acquire()
+        try:
+            return self._take()
+        finally:
+            self.lock.release()
 
+    def checkin(self, jsh, idx):
+        if idx == self.OVERFLOW_HANDLER_IDX:
+            # the spare process exits once its socket is closed
+            jsh.close()
+            if jsh.timed_out:
+                self.lock.acquire()
+                self.timeout_count += 1
+                self.lock.release()
+        else:
+            # check handler back into cache
+            self.lock.acquire()
+            try:
+                if self.handlers[idx] is not jsh:
+                    # the child process died and its slot has been given to
+                    # a replacement which started with nothing in flight.
+                    return
+                level = self.inflight[idx]
+                if level < self.pipeline:
+                    self.free[level].pop( idx, None )
+                level -= 1
+                self.inflight[idx] = level
+                self.last_used[idx] = time.time()
+                self.served[idx] += 1
+                if idx in self.recycling:
+                    if level == 0:
+                        # drained, the supervisor replaces the process
+                        self._wake()
+                elif idx not in self.dead:
+                    self.free[level][idx] = True
+                    self.lock.notify()
+                    if self.limits[idx] and self.served[idx] == self.limits[idx]:
+                        self._wake()
+            finally:
+                self.lock.release()
+
+    def _counts(self):
+        # (live processes, busy live processes), must hold the lock
+        live = len(self.handlers) - len(self.dead) - len(self.retired)
+        busy = 0
+        for idx in range(0,len(self.handlers)):
+            if self.inflight[idx] > 0 and idx not in self.dead:
+                busy += 1
+        return (live, busy)
+
+    def pids(self):
+        "process ids of the javascript processes in the pool"
+        self.lock.acquire()
+        try:
+            return [jsh.pid for jsh in self.handlers \
+                if jsh is not None and jsh.pid]
+        finally:
+            self.lock.release()
 
+    def stats(self):
+        "snapshot of the pool state"
+        self.lock.acquire()
+        try:
+            (live, busy) = self._counts()
+            return {
+                'size': live,
+                'busy': busy,
+                'idle': live - busy,
+                'dead': len(self.dead),
+                'retired': len(self.retired),
+                'inflight': sum(self.inflight),
+                'waiting': self.waiting + sum([f() for f in self.queue_depth]),
+                'overflow': self.overflow_count,
+                'pool_wait': self.pool_wait.report(),
+                'overflow_wait': self.overflow_wait.report(),
+                'min': self.pool_min,
+                'max': self.pool_max,
+                'scale_up': self.scale_up_count,
+                'scale_down': self.scale_down_count,
+                'respawned': self.respawn_count,
+                'recycled': self.recycle_count,
+                'timeouts': self.timeout_count,
+                'recycling': len(self.recycling),
+                'scale_log': [msg for (t,msg) in self.scale_log]
+            }
+        finally:
+            self.lock.release()
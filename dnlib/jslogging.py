@@ -1,6 +1,19 @@
 import logging
+import logging.handlers
 import jsapi
+import jsengine
 import os
+import time
+import errno
+import select
+import socket
+import marshal
+import threading
+
+
+# spans of the log calls made by a traced request, set by the javascript
+# process while it runs one
+LogSpans = None
 
 
 def format_args( args ):
@@ -18,7 +31,7 @@ def format_args( args ):
         return _stringify(args[0]) 
     else:
         if np == 2 and type(args[0]) == type("") and \
-          str(type(args[1])).find('PyV8.JSObject') != -1:
+          jsengine.current().isObject(args[1]):
             # func("%(param1)s ..." % {param1:'hello'})
             return args[0] % dict(args[1]) 
         else:
@@ -34,7 +47,12 @@ class jslogger(object):
             def __init__(self, f):
                 self.func = f
             def __call__(self, *args):
-                self.func( format_args( args ) )  
+                if LogSpans is None:
+                    self.func( format_args( args ) )  
+                else:
+                    start = time.time()
+                    self.func( format_args( args ) )
+                    LogSpans.append( ('log', start, time.time()) )
         return _func_wrapper( func )
 
     def setLevel(self, n):
@@ -80,46 +98,212 @@ class RootLogger():
 
 
 
-class PipeLogger():
-    """ Private logger for the javascript callbacks, this object routes log
-        messages back to the parent process (cherrypy) for logging.
+class RouteLogger():
+    """ Private logger for the javascript callbacks of a route. Records go
+        through the log channel of the javascript process to the parent
+        process (cherrypy) for logging.
     """
     def __init__(self, logger_name, logLevel=logging.DEBUG):
-
-        self.r,self.w = os.pipe()
-        self.rr = os.fdopen(self.r,"r")
-        self.ww = os.fdopen(self.w,"w")
-
-        # create logger
         self.logger = logging.getLogger(logger_name)
         self.logger.setLevel(logLevel)
-
-        # create console handler and set level to debug
-        ch = logging.StreamHandler(self.ww)
-        ch.setLevel(logging.DEBUG)
-
-        # create formatter
-        formatter = logging.Formatter(\
-           '%(asctime)s %(name)s [%(levelname)s] %(message)s')
-
-        # add formatter to ch
-        ch.setFormatter(formatter)
-
-        # add ch to logger
-        self.logger.addHandler(ch)
+        self.logger.propagate = False
+        self.logger.addHandler(Channel)
 
     def getLogger(self):
         return jslogger( self.logger )
 
 
-    def fileno(self):
-        return self.r
+# flush the records buffered by a javascript process once they reach
+BATCH_RECORDS = 256
+BATCH_BYTES = 32 * 1024
+# longer messages are truncated so a record always fits in a datagram
+MAX_MESSAGE = 60 * 1024
+# records the parent buffers before writing them out
+DRAIN_CAPACITY = 1024
+FORMAT = '%(asctime)s %(name)s [%(levelname)s] %(message)s'
 
-    def read(self, n=0xffff):
-        return os.read( self.r, n )
 
-    def close(self):
-        self.rr.close()
-        self.ww.close()
+def channelPair():
+    """
+    (read end, write end) of a log channel. A datagram socket so every
+    batch arrives whole, even with several processes writing to one end.
+    """
+    (r, w) = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+    try:
+        w.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, 1024 * 1024)
+        r.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 1024 * 1024)
+    except socket.error:
+        pass
+    return (r, w)
 
 
+class LogChannel(logging.Handler):
+    """
+    Handler of every route logger. A javascript process attaches it to the
+    write end of its log channel, records are then buffered and sent as
+    batches of (route, level, time, message) when the request is done, the
+    batch is full or an error is logged. Before attach() records are
+    written to the root logger right away.
+    """
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.sock = None
+        self.batch = []
+        self.size = 0
+
+    def attach(self, sock):
+        "send the records of this process to 'sock' from now on"
+        self.sock = sock
+        self.batch = []
+        self.size = 0
+
+    def emit(self, record):
+        msg = record.getMessage()
+        if len(msg) > MAX_MESSAGE:
+            msg = msg[:MAX_MESSAGE] + '...'
+        if self.sock is None:
+            _write(record.name, record.levelno, record.created, msg)
+            return
+        self.batch.append( (record.name, record.levelno, record.created, msg) )
+        self.size += len(msg)
+        if len(self.batch) >= BATCH_RECORDS or self.size >= BATCH_BYTES or \
+          record.levelno >= logging.ERROR:
+            self.flush()
+
+    def flush(self):
+        "send the buffered records"
+        if not self.batch or self.sock is None:
+            return
+        (batch, self.batch, self.size) = (self.batch, [], 0)
+        try:
+            self.sock.send( marshal.dumps(batch) )
+        except socket.error:
+            # the parent went away, nobody is left to log to
+            pass
+
+
+# handler shared by the route loggers of a process
+Channel = LogChannel()
+
+
+def _write(name, level, created, msg):
+    # the root logger is a passthrough with no formatting except
+    # %(message)s, so it is the collection point of the route loggers.
+    logging.info( _Formatter.format(logging.makeLogRecord({
+        'name': name,
+        'levelno': level,
+        'levelname': logging.getLevelName(level),
+        'created': created,
+        'msecs': (created - long(created)) * 1000,
+        'msg': msg
+    })) )
+
+_Formatter = logging.Formatter(fmt=FORMAT)
+
+
+class _Passthrough(logging.Handler):
+    def emit(self, record):
+        _write(record.name, record.levelno, record.created, record.msg)
+
+
+class LogDrain(object):
+    """
+    Parent side of the log channels, a thread reads the batches of every
+    javascript process and writes their records through a buffered
+    handler, flushed when the channels go quiet or an error shows up.
+    """
+    def __init__(self):
+        self.socks = {}
+        self.lock = threading.Lock()
+        (self.wake_r, self.wake_w) = os.pipe()
+        self.handler = logging.handlers.MemoryHandler(DRAIN_CAPACITY,
+            logging.ERROR, _Passthrough())
+        self.thread = None
+
+    def fds(self):
+        "file descriptors child processes must not keep"
+        return [self.wake_r, self.wake_w]
+
+    def forget(self):
+        "called after a fork, the drain thread is not running in the child"
+        self.lock = threading.Lock()
+        self.socks = {}
+        self.thread = None
+
+    def add(self, sock):
+        "drain the read end 'sock' of a log channel"
+        self.lock.acquire()
+        try:
+            self.socks[sock.fileno()] = sock
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run,
+                    name="js-log-drain")
+                self.thread.daemon = True
+                self.thread.start()
+        finally:
+            self.lock.release()
+        os.write(self.wake_w, 'x')
+
+    def remove(self, sock):
+        "stop draining 'sock', what it holds is read first"
+        self.lock.acquire()
+        try:
+            if self.socks.pop(sock.fileno(), None) is not None:
+                self._drain(sock)
+        finally:
+            self.lock.release()
+
+    def _drain(self, sock):
+        while True:
+            try:
+                data = sock.recv(1 << 20, socket.MSG_DONTWAIT)
+            except socket.error:
+                return
+            if not data:
+                return
+            for (name, level, created, msg) in marshal.loads(data):
+                record = logging.makeLogRecord({
+                    'name': name,
+                    'levelno': level,
+                    'levelname': logging.getLevelName(level),
+                    'created': created,
+                    'msg': msg
+                })
+                self.handler.handle(record)
+
+    def _run(self):
+        while True:
+            self.lock.acquire()
+            p = select.poll()
+            for fd in self.socks:
+                p.register(fd, select.POLLIN)
+            self.lock.release()
+            p.register(self.wake_r, select.POLLIN)
+            try:
+                events = p.poll(100)
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if not events:
+                # quiet, write out what is buffered
+                self.handler.flush()
+                continue
+            for (fd, evt) in events:
+                if fd == self.wake_r:
+                    os.read(self.wake_r, 4096)
+                    continue
+                self.lock.acquire()
+                try:
+                    sock = self.socks.get(fd)
+                    if sock is not None:
+                        self._drain(sock)
+                        if evt & (select.POLLHUP | select.POLLERR | select.POLLNVAL):
+                            # the process exited, its owner closes the socket
+                            del self.socks[fd]
+                finally:
+                    self.lock.release()
+
+
+# log channels of the javascript processes drained by the parent
+Drain = LogDrain()
@@ -0,0 +1,152 @@
+"""
+Memory of the javascript processes. They are forked from the server and
+share its pages copy-on-write until either side writes to them, python
+writes to an object whenever its reference count changes and the cyclic
+garbage collector writes to every object it traverses. To keep as much as
+possible shared the server warms up before it forks:
+
+    api.settings({'warmup': {'require': ['lib/report',
+                                         ['geoip', {'language': 'python'}]],
+                             'import': ['decimal', 'xml.dom.minidom'],
+                             'gc': true, 'gen2_threshold': 100}})
+
+'require' loads modules the handlers require() lazily so the javascript
+processes find them in the module cache instead of loading their own
+copy, 'import' does the same for python modules. A full collection then
+runs before the fork (gc.freeze() is used as well on pythons that have
+it), and the javascript processes run full collections 'gen2_threshold'
+times less often than python's default so old objects are left alone.
+
+The shared and private memory of every javascript process is read from
+/proc/<pid>/smaps_rollup and exported on the metrics page, by hand with
+
+    python dnlib/jsmemory.py PID...
+"""
+import os
+import gc
+import sys
+import logging
+
+import jsengine
+import require
+
+
+DEFAULT_GEN2_THRESHOLD = 100
+
+# 'warmup' setting, inherited by the javascript processes
+Settings = None
+
+# smaps fields in kB summed into each figure of usage()
+_FIELDS = {
+    'rss': ('Rss',),
+    'pss': ('Pss',),
+    'shared': ('Shared_Clean', 'Shared_Dirty'),
+    'private': ('Private_Clean', 'Private_Dirty'),
+    'swap': ('Swap',)
+}
+
+
+class _Options(jsengine.JSClass):
+    "require() options given as a dict in the settings"
+    def __init__(self, options):
+        jsengine.JSClass.__init__(self)
+        for (k, v) in options.items():
+            setattr(self, str(k), v)
+
+
+def usage(pid):
+    """
+    Memory of process 'pid' in bytes as a dict with rss, pss, shared,
+    private and swap, None if the process is gone.
+    """
+    kb = {}
+    for name in ('smaps_rollup', 'smaps'):
+        try:
+            f = open('/proc/%d/%s' % (pid, name))
+        except IOError:
+            continue
+        try:
+            # smaps lists every mapping, the rollup has a single one
+            for line in f:
+                parts = line.split()
+                if len(parts) == 3 and parts[2] == 'kB':
+                    key = parts[0].rstrip(':')
+                    kb[key] = kb.get(key, 0) + int(parts[1])
+        finally:
+            f.close()
+        break
+    else:
+        return None
+    return dict([(k, sum([kb.get(f, 0) for f in fields]) * 1024) \
+        for (k, fields) in _FIELDS.items()])
+
+
+def rss(pid):
+    "resident memory of process 'pid' in bytes, cheap enough to poll"
+    try:
+        f = open('/proc/%d/statm' % pid)
+    except IOError:
+        return None
+    try:
+        return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    finally:
+        f.close()
+
+
+def report(pids):
+    "usage() of every process in 'pids' that is still running, by pid"
+    result = {}
+    for pid in pids:
+        u = usage(pid)
+        if u is not None:
+            result[pid] = u
+    return result
+
+
+def warmup(options):
+    """
+    Load what the 'warmup' setting lists and collect garbage, run by the
+    server right before it forks the javascript processes.
+    """
+    global Settings
+    if options is None or options is False:
+        Settings = None
+        return
+    if options is True:
+        options = {}
+    Settings = jsengine.current().toPython(options)
+    Settings.setdefault('gc', True)
+    Settings.setdefault('gen2_threshold', DEFAULT_GEN2_THRESHOLD)
+
+    for spec in Settings.get('require', []):
+        opt = {}
+        if type(spec) in (list, tuple):
+            (spec, opt) = spec
+        require.require(str(spec), _Options(opt))
+    for name in Settings.get('import', []):
+        __import__(str(name))
+
+    if Settings['gc']:
+        n = gc.collect()
+        if hasattr(gc, 'freeze'):
+            # keep the collector away from everything allocated so far
+            gc.freeze()
+        logging.info("warmup collected %d objects before forking" % n)
+
+
+def childInit():
+    "called by a javascript process before it serves requests"
+    if Settings is None or not Settings['gc']:
+        return
+    (t0, t1, t2) = gc.get_threshold()
+    gc.set_threshold(t0, t1, t2 * int(Settings['gen2_threshold']))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        sys.exit("usage: %s PID..." % sys.argv[0])
+    print "%8s %10s %10s %10s %10s" % ('pid', 'rss kB', 'pss kB',
+        'shared kB', 'private kB')
+    for (pid, u) in sorted(report([int(p) for p in sys.argv[1:]]).items()):
+        print "%8d %10d %10d %10d %10d" % (pid, u['rss'] / 1024,
+            u['pss'] / 1024, u['shared'] / 1024, u['private'] / 1024)
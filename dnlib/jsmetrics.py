@@ -0,0 +1,213 @@
+"""
+Low overhead request metrics exposed in the Prometheus text format.
+
+Latencies go into log-linear histograms (HDR style): every power of two is
+split into SUB_BUCKETS linear buckets so the relative error of a bucket is
+bounded, and an observation costs a frexp and a list increment. Each
+request records the time spent in every stage:
+
+    queue     waiting in JsPool.checkout for a javascript process
+    ipc       round trip to the child minus the time spent in javascript
+    js        running the javascript callback, measured in the child
+    process   turning the result into the response in the parent
+    total     from the start of the handler until the response is ready
+
+Pool, cache and compression counters are read from collectors when the
+metrics page is rendered, so they cost nothing per request.
+"""
+import math
+import threading
+import cherrypy
+
+
+# histogram range, 2**MIN_EXP (61us) up to 2**MAX_EXP (64s)
+MIN_EXP = -14
+MAX_EXP = 6
+SUB_BUCKETS = 2
+
+NBUCKETS = (MAX_EXP - MIN_EXP) * SUB_BUCKETS
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+STAGES = ('queue', 'ipc', 'js', 'process', 'total')
+
+
+def _bound(idx):
+    "upper bound of histogram bucket idx"
+    octave, k = divmod(idx, SUB_BUCKETS)
+    return math.ldexp(1.0 + float(k + 1) / SUB_BUCKETS, MIN_EXP + octave)
+
+BOUNDS = [_bound(i) for i in range(NBUCKETS)]
+
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (NBUCKETS + 1)   # last bucket is +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def observe(self, v):
+        if v <= 0:
+            idx = 0
+        else:
+            (m, e) = math.frexp(v)
+            # v = 2**(e-1) * (2m), 2m in [1,2)
+            idx = (e - 1 - MIN_EXP) * SUB_BUCKETS + int((2 * m - 1) * SUB_BUCKETS)
+            if idx < 0:
+                idx = 0
+            elif idx > NBUCKETS:
+                idx = NBUCKETS
+        self.lock.acquire()
+        self.counts[idx] += 1
+        self.sum += v
+        self.count += 1
+        self.lock.release()
+
+    def snapshot(self):
+        self.lock.acquire()
+        try:
+            return (list(self.counts), self.sum, self.count)
+        finally:
+            self.lock.release()
+
+
+def _labels(labels, extra=None):
+    items = list(labels)
+    if extra:
+        items.append(extra)
+    if not items:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (k, str(v).replace('\\', '\\\\')
+        .replace('"', '\\"').replace('\n', '\\n')) for (k, v) in items])
+
+
+class Metrics(object):
+    """
+    Histograms and counters keyed by name and a tuple of (label, value)
+    pairs, plus collectors called at render time. A collector returns a
+    list of (name, type, help, [(labels, value), ...]).
+    """
+    def __init__(self, prefix='dn_'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.counters = {}
+        self.collectors = []
+        self.help = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, labels, value):
+        key = (name, labels)
+        h = self.histograms.get(key)
+        if h is None:
+            self.lock.acquire()
+            h = self.histograms.setdefault(key, Histogram())
+            self.lock.release()
+        h.observe(value)
+
+    def inc(self, name, labels, n=1):
+        key = (name, labels)
+        self.lock.acquire()
+        self.counters[key] = self.counters.get(key, 0) + n
+        self.lock.release()
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def addCollector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        "all metrics in the Prometheus text exposition format"
+        out = []
+        self.lock.acquire()
+        histograms = sorted(self.histograms.items())
+        counters = sorted(self.counters.items())
+        self.lock.release()
+
+        families = {}
+        for ((name, labels), h) in histograms:
+            families.setdefault(name, []).append((labels, h))
+        for name in sorted(families.keys()):
+            full = self.prefix + name
+            self._header(out, full, name, 'histogram')
+            for (labels, h) in families[name]:
+                (counts, total, count) = h.snapshot()
+                cumulative = 0
+                for i in range(NBUCKETS):
+                    cumulative += counts[i]
+                    out.append('%s_bucket%s %d' % (full,
+                        _labels(labels, ('le', '%.6g' % BOUNDS[i])), cumulative))
+                out.append('%s_bucket%s %d' % (full,
+                    _labels(labels, ('le', '+Inf')), count))
+                out.append('%s_sum%s %.9f' % (full, _labels(labels), total))
+                out.append('%s_count%s %d' % (full, _labels(labels), count))
+
+        families = {}
+        for ((name, labels), n) in counters:
+            families.setdefault(name, []).append((labels, n))
+        for name in sorted(families.keys()):
+            full = self.prefix + name
+            self._header(out, full, name, 'counter')
+            for (labels, n) in families[name]:
+                out.append('%s%s %d' % (full, _labels(labels), n))
+
+        for collector in self.collectors:
+            for (name, kind, text, samples) in collector():
+                full = self.prefix + name
+                out.append('# HELP %s %s' % (full, text))
+                out.append('# TYPE %s %s' % (full, kind))
+                for (labels, v) in samples:
+                    out.append('%s%s %s' % (full, _labels(labels), v))
+        return '\n'.join(out) + '\n'
+
+    def _header(self, out, full, name, kind):
+        if name in self.help:
+            out.append('# HELP %s %s' % (full, self.help[name]))
+        out.append('# TYPE %s %s' % (full, kind))
+
+
+# metrics of this process
+Registry = Metrics()
+Registry.describe('stage_seconds',
+    'time spent by requests in each stage (queue, ipc, js, process, total)')
+Registry.describe('requests_total', 'requests handled by route, method and status')
+
+
+def recordRequest(path, method, status, start, checked_out=None,
+  replied=None, js_time=None, done=None):
+    """
+    Record the stage timings of one request, timestamps come from
+    time.time(). A request answered without a javascript process (cache
+    hit) only has a start and done time.
+    """
+    route = (('route', path), ('method', method))
+    if checked_out is not None:
+        Registry.observe('stage_seconds', route + (('stage', 'queue'),),
+            checked_out - start)
+    if replied is not None:
+        rtt = replied - checked_out
+        if js_time is not None:
+            Registry.observe('stage_seconds', route + (('stage', 'js'),), js_time)
+            rtt = max(0.0, rtt - js_time)
+        Registry.observe('stage_seconds', route + (('stage', 'ipc'),), rtt)
+        if done is not None:
+            Registry.observe('stage_seconds', route + (('stage', 'process'),),
+                done - replied)
+    if done is not None:
+        Registry.observe('stage_seconds', route + (('stage', 'total'),),
+            done - start)
+    Registry.inc('requests_total', route + (('status', str(status)),))
+
+
+class MetricsController(object):
+    "serves the metrics page, registered on the 'metrics_path' route"
+    def __init__(self, registry=Registry):
+        self.registry = registry
+
+    def render(self):
+        return self.registry.render()
+
+    def __call__(self, **params):
+        cherrypy.response.headers['Content-Type'] = CONTENT_TYPE
+        return self.render()
@@ -0,0 +1,236 @@
+"""
+Sampling profiler for the javascript processes. Each child samples its
+python stack on a SIGPROF interval timer and counts the stacks in the
+folded format used by flamegraph.pl and speedscope, the root frame of a
+stack is the route being served:
+
+    [http]/report;jshandler.py:run;jshandler.py:_serve;jshandler.py:_jsexec;jsapi.py:expand 12
+
+Time spent inside V8 is charged to the python frame that called into it
+(_jsexec for the callback itself), python helpers called from javascript
+through the HandlerAPI show up as their own frames. Signals that arrive
+while V8 runs are merged by python into one, so a sample is weighted by
+the CPU time elapsed since the previous one.
+
+Enabled with 'dreadnought.py --profile DIR' or the 'profile' setting:
+
+    api.settings({'profile': {'dir': '/tmp/dn-profile', 'interval': 0.01,
+                              'enabled': false}})
+
+Every child writes DIR/<pid>.folded between requests, once 'flush'
+seconds went by since it last did and after the profiler is turned off.
+The signal handlers only count stacks and start or stop the timer, they
+never touch the file. SIGUSR2 sent to the server toggles profiling in all
+of its javascript processes at runtime, turning it off also merges the
+files of every child into DIR/profile.folded. The files can also be
+merged by hand with
+
+    python dnlib/jsprofile.py DIR > profile.folded
+"""
+import os
+import sys
+import time
+import signal
+import logging
+import threading
+
+
+DEFAULT_INTERVAL = 0.01
+DEFAULT_FLUSH = 10.0
+
+# 'profile' setting, inherited by the javascript processes
+Settings = None
+
+# sampler of this javascript process
+Active = None
+
+
+def _enabledFile():
+    return os.path.join(Settings['dir'], 'enabled')
+
+
+class Sampler(object):
+    "counts folded python stacks of this process"
+    def __init__(self, path, interval=DEFAULT_INTERVAL, flush=DEFAULT_FLUSH):
+        self.path = path
+        self.interval = float(interval)
+        self.flush_interval = float(flush)
+        self.counts = {}
+        self.route = None
+        # frames below it (the fork of the process) are left out
+        self.root = None
+        self.running = False
+        self.last_cpu = 0.0
+        self.last_flush = 0.0
+        # stopped with stacks not written yet
+        self.unsaved = False
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self.last_cpu = time.clock()
+        self.last_flush = time.time()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.siginterrupt(signal.SIGPROF, False)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        "stop sampling, the next flushIfDue() writes the stacks"
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        self.running = False
+        self.unsaved = True
+
+    def _sample(self, signum, frame):
+        now = time.clock()
+        weight = max(1, int(round((now - self.last_cpu) / self.interval)))
+        self.last_cpu = now
+
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append('%s:%s' % (os.path.basename(code.co_filename),
+                code.co_name))
+            if frame is self.root:
+                break
+            frame = frame.f_back
+        stack.append(self.route or '(idle)')
+        stack.reverse()
+        key = ';'.join(stack)
+        self.counts[key] = self.counts.get(key, 0) + weight
+
+    def flushIfDue(self):
+        if self.unsaved or (self.running and \
+          time.time() - self.last_flush > self.flush_interval):
+            self.flush()
+
+    def flush(self):
+        "rewrite the folded stacks file of this process"
+        self.last_flush = time.time()
+        self.unsaved = False
+        tmp = self.path + '.tmp'
+        f = open(tmp, 'w')
+        for (stack, n) in self.counts.items():
+            f.write('%s %d\n' % (stack, n))
+        f.close()
+        os.rename(tmp, self.path)
+
+
+def configure(options):
+    """
+    Set up profiling from the 'profile' setting, must run before the
+    javascript processes are forked.
+    """
+    global Settings
+    if not options:
+        Settings = None
+        return
+    if isinstance(options, basestring):
+        options = {'dir': options}
+    Settings = dict(options)
+    Settings.setdefault('dir', '/tmp/dn-profile')
+    Settings.setdefault('interval', DEFAULT_INTERVAL)
+    Settings.setdefault('flush', DEFAULT_FLUSH)
+    if not os.path.isdir(Settings['dir']):
+        os.makedirs(Settings['dir'])
+    setEnabled(Settings.get('enabled', True))
+
+
+def setEnabled(enabled):
+    "record whether the javascript processes should be sampling"
+    if enabled:
+        open(_enabledFile(), 'w').close()
+    elif os.path.exists(_enabledFile()):
+        os.unlink(_enabledFile())
+
+
+def isEnabled():
+    return Settings is not None and os.path.exists(_enabledFile())
+
+
+def childInit():
+    "called by a javascript process before it serves requests"
+    global Active
+    if Settings is None:
+        return
+    Active = Sampler(os.path.join(Settings['dir'], '%d.folded' % os.getpid()),
+        Settings['interval'], Settings['flush'])
+    Active.root = sys._getframe(1)
+    signal.signal(signal.SIGUSR2, _childToggle)
+    signal.siginterrupt(signal.SIGUSR2, False)
+    if isEnabled():
+        Active.start()
+
+
+def _childToggle(signum, frame):
+    if isEnabled():
+        Active.start()
+    else:
+        Active.stop()
+
+
+def setRoute(route):
+    "name of the route being served, None between requests"
+    if Active is not None:
+        Active.route = route
+
+
+def flushIfDue():
+    "called by a javascript process between requests and when it is woken up"
+    if Active is not None:
+        Active.flushIfDue()
+
+
+def toggle(pids):
+    """
+    Turn profiling on or off in the javascript processes 'pids', turning
+    it off merges their stacks into DIR/profile.folded once they flushed.
+    Returns the new state.
+    """
+    enabled = not isEnabled()
+    setEnabled(enabled)
+    for pid in pids:
+        try:
+            os.kill(pid, signal.SIGUSR2)
+        except OSError:
+            pass
+    if not enabled:
+        t = threading.Timer(1.0, merge, (Settings['dir'],
+            os.path.join(Settings['dir'], 'profile.folded')))
+        t.daemon = True
+        t.start()
+    logging.info("profiling %s" % (enabled and "started" or "stopped"))
+    return enabled
+
+
+def installToggle(pids):
+    "toggle profiling on SIGUSR2, pids() lists the javascript processes"
+    if Settings is None:
+        return
+    signal.signal(signal.SIGUSR2, lambda signum, frame: toggle(pids()))
+
+
+def merge(directory, output=None):
+    "sum the folded stacks of every process, written to output or returned"
+    counts = {}
+    for name in os.listdir(directory):
+        if not name.endswith('.folded') or name == 'profile.folded':
+            continue
+        for line in open(os.path.join(directory, name)):
+            (stack, sep, n) = line.rstrip('\n').rpartition(' ')
+            if sep:
+                counts[stack] = counts.get(stack, 0) + int(n)
+    lines = ['%s %d\n' % item for item in sorted(counts.items())]
+    if output is None:
+        return ''.join(lines)
+    f = open(output, 'w')
+    f.writelines(lines)
+    f.close()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.exit("usage: %s DIR" % sys.argv[0])
+    sys.stdout.write(merge(sys.argv[1]))
@@ -0,0 +1,357 @@
+"""
+Record a sample of the production traffic and replay it offline against a
+fresh javascript process pool.
+
+Recording is turned on with the 'record' setting, every sampled request
+that reached a javascript process is appended to the log as one JSON line
+(gzip compressed when the file name ends in .gz). The log holds the post
+data of the requests, it is created readable by its owner only and
+defaults to ~/.dreadnought-js/traffic.log:
+
+    api.settings({'record': {'path': '/var/tmp/traffic.log.gz',
+                             'sample': 0.1, 'max_bytes': 256*1024*1024}})
+
+    {"t": 1466000000.123, "path": "/report", "method": "GET",
+     "qs": {"year": "2016"}, "post": {}, "status": 200, "ms": 4.1,
+     "js_ms": 2.9, "bytes": 5120}
+
+Responses served from the response cache never reach the pool and are not
+recorded. Byte strings that are not UTF-8 are logged as {"$base64": ...}
+and restored by load(). Every line is flushed as it is written, a log cut short by a
+killed server loads up to its last complete line. A gzip log can not be
+read past a member cut short that way, which is why the default log is
+plain text. The log is replayed with
+
+    dn replay traffic.log.gz app.js --speed 10 --js-pool 8 --codec marshal
+
+which runs app.js to register its routes, starts the pool with the given
+settings and sends every recorded request at its original offset divided
+by 'speed' (0 sends them as fast as possible). Latency is measured from
+the time a request was due, so a pool that falls behind shows it.
+"""
+import os
+import time
+import json
+import gzip
+import zlib
+import base64
+import random
+import logging
+import threading
+import traceback
+import collections
+
+
+DEFAULT_SAMPLE = 1.0
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+DEFAULT_THREADS = 64
+DEFAULT_PATH = os.path.join(os.environ['HOME'], '.dreadnought-js',
+    'traffic.log')
+
+# global recorder set up from the 'record' setting
+Default = None
+
+# key of the object standing for a byte string that is not UTF-8
+BINARY = '$base64'
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+def _create(path):
+    "open the log for appending, a new log is private to its owner"
+    directory = os.path.dirname(path)
+    if directory and not os.path.isdir(directory):
+        os.makedirs(directory, 0700)
+    os.close(os.open(path, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0600))
+    return _open(path, 'ab')
+
+
+def _encodeValue(v):
+    "a value json can write, byte strings that are not UTF-8 as base64"
+    t = type(v)
+    if t == str:
+        try:
+            v.decode('utf-8')
+        except UnicodeDecodeError:
+            return {BINARY: base64.b64encode(v)}
+    elif t == dict:
+        return dict([(_encodeKey(k), _encodeValue(x)) for (k, x) in v.items()])
+    elif t == list or t == tuple:
+        return [_encodeValue(x) for x in v]
+    return v
+
+
+def _encodeKey(k):
+    # keys can not be replaced by an object, they are read as latin-1
+    if type(k) == str:
+        try:
+            k.decode('utf-8')
+        except UnicodeDecodeError:
+            return k.decode('latin-1')
+    return k
+
+
+def _decodeValue(v):
+    "reverse of _encodeValue()"
+    t = type(v)
+    if t == dict:
+        if len(v) == 1 and BINARY in v:
+            return base64.b64decode(v[BINARY])
+        return dict([(k, _decodeValue(x)) for (k, x) in v.items()])
+    elif t == list:
+        return [_decodeValue(x) for x in v]
+    return v
+
+
+class Recorder(object):
+    "appends a sample of the requests to a traffic log"
+    def __init__(self, path, sample=DEFAULT_SAMPLE, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.sample_rate = float(sample)
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+        self.f = None
+        self.written = 0
+        self.recorded = 0
+        self.failed = 0
+
+    def record(self, req, status, start, done, js_time=None, size=None):
+        """
+        log a request handled by a javascript process, if it is sampled.
+        Never raises, the request is answered whether it was logged or not.
+        """
+        if self.written >= self.max_bytes or random.random() >= self.sample_rate:
+            return
+        try:
+            self._write(req, status, start, done, js_time, size)
+        except:
+            self.failed += 1
+            if self.failed == 1:
+                # once, a full disk would log it for every request
+                logging.error("recording traffic to %s failed\n%s" % \
+                    (self.path, traceback.format_exc()))
+
+    def _write(self, req, status, start, done, js_time, size):
+        entry = {
+            't': start,
+            'path': req['path'],
+            'method': req['method'],
+            'qs': _encodeValue(req['qs_params']),
+            'post': _encodeValue(req['post_data']),
+            'status': status,
+            'ms': round((done - start) * 1000.0, 3)
+        }
+        if js_time is not None:
+            entry['js_ms'] = round(js_time * 1000.0, 3)
+        if size is not None:
+            entry['bytes'] = size
+        # uploaded files and the like are logged as their repr
+        line = json.dumps(entry, default=repr, separators=(',', ':')) + '\n'
+
+        self.lock.acquire()
+        try:
+            if self.written >= self.max_bytes:
+                return
+            if self.f is None:
+                self.f = _create(self.path)
+            self.f.write(line)
+            # a killed server keeps everything recorded so far
+            self.f.flush()
+            self.written += len(line)
+            self.recorded += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f:
+                self.f.close()
+                self.f = None
+        finally:
+            self.lock.release()
+
+
+def fromOptions(options):
+    "build a Recorder from the 'record' setting, None if recording is off"
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    if isinstance(options, basestring):
+        options = {'path': options}
+    opt = dict(options)
+    return Recorder(opt.get('path', DEFAULT_PATH),
+        opt.get('sample', DEFAULT_SAMPLE),
+        opt.get('max_bytes', DEFAULT_MAX_BYTES))
+
+
+def configure(options):
+    "set up the global recorder from the 'record' setting"
+    global Default
+    if Default is not None:
+        Default.close()
+    Default = fromOptions(options)
+
+
+def close():
+    "close the log of the global recorder, the server is stopping"
+    if Default is not None:
+        Default.close()
+
+
+def load(path):
+    """
+    Recorded requests ordered by their start time. A log whose tail was
+    cut short by a killed server is read up to its last complete line.
+    """
+    entries = []
+    f = _open(path, 'rb')
+    try:
+        try:
+            for line in f:
+                if line.strip():
+                    entry = json.loads(line)
+                    entry['qs'] = _decodeValue(entry['qs'])
+                    entry['post'] = _decodeValue(entry['post'])
+                    entries.append(entry)
+        except (IOError, EOFError, ValueError, zlib.error), e:
+            logging.warning("%s is truncated, replaying %d requests: %s" % \
+                (path, len(entries), e))
+    finally:
+        f.close()
+    entries.sort(key=lambda e: e['t'])
+    return entries
+
+
+def _percentile(samples, p):
+    k = min(len(samples) - 1, int(round(p / 100.0 * (len(samples) - 1))))
+    return samples[k]
+
+
+def _summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {'count': 0}
+    return {
+        'count': len(samples),
+        'p50_ms': _percentile(samples, 50) * 1000.0,
+        'p90_ms': _percentile(samples, 90) * 1000.0,
+        'p99_ms': _percentile(samples, 99) * 1000.0,
+        'max_ms': samples[-1] * 1000.0
+    }
+
+
+def replay(registry, pool, entries, speed=1.0, threads=DEFAULT_THREADS):
+    """
+    Send the recorded requests to the routes of 'registry' through 'pool'
+    and return the latency distribution of every route and of the whole
+    replay. A request goes to the route registered for its path and
+    method, or else for its path and any method. Streaming routes and
+    paths that are not registered are skipped.
+    """
+    controllers = {}
+    for c in registry.controllers:
+        if not c.options.get('stream', False):
+            method = c.options.get('method', None)
+            controllers[(c.path, method and str(method).upper())] = c
+    work = collections.deque()
+    cond = threading.Condition()
+    latencies = collections.defaultdict(list)
+    errors = collections.defaultdict(int)
+    skipped = [0]
+    finished = [False]
+
+    def worker():
+        while True:
+            cond.acquire()
+            while not work and not finished[0]:
+                cond.wait()
+            if not work:
+                cond.release()
+                return
+            (due, controller, entry) = work.popleft()
+            cond.release()
+
+            req = controller._request(str(entry['method']),
+                dict(entry['qs']), dict(entry['post']))
+            jsh, idx = pool.checkout()
+            try:
+                jsh.transaction(req)
+                ok = True
+            except:
+                ok = False
+            pool.checkin(jsh, idx)
+            elapsed = time.time() - due
+
+            cond.acquire()
+            latencies[controller.path].append(elapsed)
+            if not ok:
+                errors[controller.path] += 1
+            cond.release()
+
+    workers = [threading.Thread(target=worker) for i in range(threads)]
+    for t in workers:
+        t.daemon = True
+        t.start()
+
+    start = time.time()
+    first = entries and entries[0]['t'] or 0
+    for entry in entries:
+        controller = controllers.get((entry['path'], entry['method']),
+            controllers.get((entry['path'], None)))
+        if controller is None:
+            skipped[0] += 1
+            continue
+        due = start
+        if speed > 0:
+            due = start + (entry['t'] - first) / speed
+            delay = due - time.time()
+            if delay > 0:
+                time.sleep(delay)
+        cond.acquire()
+        work.append((due, controller, entry))
+        cond.notify()
+        cond.release()
+
+    cond.acquire()
+    finished[0] = True
+    cond.notify_all()
+    cond.release()
+    for t in workers:
+        t.join()
+    elapsed = time.time() - start
+
+    every = []
+    routes = {}
+    for (path, samples) in latencies.items():
+        every.extend(samples)
+        routes[path] = _summary(samples)
+        routes[path]['errors'] = errors[path]
+    total = _summary(every)
+    total['errors'] = sum(errors.values())
+    total['skipped'] = skipped[0]
+    total['seconds'] = elapsed
+    total['req_s'] = len(every) / max(elapsed, 1e-9)
+    return {'total': total, 'routes': routes}
+
+
+def report(result):
+    "replay results as a table"
+    lines = ["%-32s %7s %9s %9s %9s %9s %6s" % ('route', 'count', 'p50 ms',
+        'p90 ms', 'p99 ms', 'max ms', 'errors')]
+    rows = sorted(result['routes'].items()) + [('total', result['total'])]
+    for (path, s) in rows:
+        if not s['count']:
+            continue
+        lines.append("%-32s %7d %9.2f %9.2f %9.2f %9.2f %6d" % (path,
+            s['count'], s['p50_ms'], s['p90_ms'], s['p99_ms'], s['max_ms'],
+            s['errors']))
+    t = result['total']
+    lines.append("%d requests in %.2fs (%.1f req/s), %d skipped" % (t['count'],
+        t['seconds'], t['req_s'], t['skipped']))
+    return '\n'.join(lines)
@@ -1,4 +1,11 @@
 import jshandler
+import jscache
+import jscompress
+import jsmetrics
+import jstrace
+import jsreplay
+import jsmemory
+import time
 import json
 import cherrypy
 import logging
@@ -23,7 +30,95 @@ class RouteController:
         self.options = options
         self.path = path
 
-    def _process_response(self, res):
+        # streamed responses are never cached
+        self.cache = None
+        if not options.get('stream',False):
+            self.cache = jscache.fromOptions( options.get('cache',None) )
+
+        # None follows the global 'compress' setting, false turns it off
+        self.compress = options.get('compress',None)
+        if self.compress:
+            self.compress = jscompress.fromOptions( self.compress )
+
+    def _cache_key(self, req):
+        "key of req in the response cache, None if it can not be cached"
+        if self.cache is None or req['post_data']:
+            return None
+        if req['method'] not in ('GET', 'HEAD'):
+            # the key only covers the query string, other methods would
+            # share the entry of a GET
+            return None
+        return self.cache.key( req['qs_params'] )
+
+    def _lookup(self, key, inm, ims):
+        """
+        Answer a request from the response cache, returns (status, headers,
+        data) or None on a miss. inm and ims are the If-None-Match and
+        If-Modified-Since request headers.
+        """
+        if key is None:
+            return None
+        hit = self.cache.get( key )
+        if hit is None:
+            return None
+        (data, headers) = hit
+        if self._not_modified( headers, inm, ims ):
+            return (304, headers, '')
+        return (200, headers, data)
+
+    def _reply(self, key, res, inm, ims, session=None):
+        """
+        Turn the result of a javascript handler into (status, headers, data),
+        adding validators and answering 304 when the client copy is current.
+        """
+        if res.get('not_modified',False):
+            # the version callback matched If-None-Match in the child
+            return (304, {'ETag': res['etag']}, '')
+
+        data = self._process_response( res, session )
+        headers = self._validators( res, data )
+        if key is not None and 'permissionLevel' not in res:
+            self.cache.put( key, data, res.get('cache',None), headers )
+        if self._not_modified( headers, inm, ims ):
+            return (304, headers, '')
+        return (200, headers, data)
+
+    def _validators(self, res, data):
+        "ETag and Last-Modified headers of a response"
+        headers = {}
+        if res.get('etag',None):
+            headers['ETag'] = jscache.quoteETag( res['etag'] )
+        elif self.options.get('etag',False):
+            headers['ETag'] = jscache.makeETag( data )
+        if res.get('last_modified',None):
+            headers['Last-Modified'] = jscache.httpDate( res['last_modified'] )
+        return headers
+
+    def _not_modified(self, headers, inm, ims):
+        # If-None-Match takes precedence over If-Modified-Since
+        if inm:
+            return jscache.etagMatches( inm, headers.get('ETag',None) )
+        if ims:
+            return jscache.notModifiedSince( ims, headers.get('Last-Modified',None) )
+        return False
+
+    def _encode(self, status, headers, data, accept_encoding):
+        "compress a reply, returns (headers, data)"
+        compressor = self.compress
+        if compressor is None:
+            compressor = jscompress.Default
+        if status != 200 or not compressor:
+            return (headers, data)
+        (data, headers) = jscompress.applyEncoding( compressor, data, headers,
+            accept_encoding )
+        return (headers, data)
+
+    def _conditional(self, req, inm):
+        # let the version callback of the route answer in the child
+        if inm and self.options.get('version',None):
+            req['if_none_match'] = inm
+
+    def _process_response(self, res, session=None):
         "Process response from child process"
 
         try:
@@ -42,73 +137,67 @@ class RouteController:
         if self.options.get('json',False):
             res['data'] = json.dumps(res['data'])
 
-        if 'permissionLevel' in res:
+        if 'permissionLevel' in res and session is not None:
             pl = int(res['permissionLevel'])
-            cherrypy.session[ cherrypy.session.id ] = pl
+            session[ session.id ] = pl
 
         logging.debug("res = %s" % str(res))
         return res['data']
 
 
-    # generator used for streaming.
+    # generator used for streaming, the callback is called over and over
+    # until it returns no data. The javascript process keeps its context
+    # entered so no extra round trips are needed around the stream.
     def generator(self, jsh, idx, req, options):
         global JsPool
 
         error = None
 
-        # explicitly enter javascript context
-        jsh.transaction({
-            'start-streaming':True,
-            'streaming': True,
-            'ident': req['ident']
-        })
-
-        # set the streaming flag so we follow a different
-        # control path in the js handler.
         req['streaming'] = True
         req['bytes_read'] = 0
-        while True:
-            res = jsh.transaction(req)
-            if 'success' in res:
-                continue 
-
-            if 'error' in res:
-                error = res['error']
-                break
-
-            # fetch streaming data
-            data = res.get('data',None)
-            if not data or len(data) == 0:
-                # no more data we're done.
-                break
-
-            req['bytes_read'] += len(data)
-
-            # return a generator to cherrypy, have it call
-            # the next method until there is no more data.
-            yield data
-
-        # explicitly leave javascript context
-        jsh.transaction({
-            'stop-streaming':True,
-            'streaming': True,
-            'ident': req['ident']
-        })
-
-        # free this child process to work on other requests.
-        JsPool.checkin(jsh, idx)
+        try:
+            while True:
+                res = jsh.transaction(req)
+                if 'error' in res:
+                    error = res['error']
+                    break
+
+                # fetch streaming data
+                data = res.get('data',None)
+                if not data or len(data) == 0:
+                    # no more data we're done.
+                    break
+
+                req['bytes_read'] += len(data)
+
+                # return a generator to cherrypy, have it call
+                # the next method until there is no more data.
+                yield data
+        finally:
+            # free this child process to work on other requests.
+            JsPool.checkin(jsh, idx)
 
         if error:
             raise RuntimeError, error
 
 
 
-    def __handler(self, method, qs_params ):
-        # see if there is post data.
+    # generator used for push streaming, the callback writes chunks which
+    # are handed to cherrypy as they arrive.
+    def push_generator(self, jsh, idx, req, options):
+        global JsPool
+
         try:
-            post_data = cherrypy.request.body.params
-        except:
-            post_data = {}
+            for data in jsh.stream( req,
+              options.get('window', jshandler.STREAM_WINDOW) ):
+                yield data
+        finally:
+            # free this child process to work on other requests.
+            JsPool.checkin(jsh, idx)
+
+
+    def _request(self, method, qs_params, post_data):
+        "Build the request passed to the javascript callback"
 
         # separate the query parameters from the post data
         for k in set(qs_params.keys()).intersection(set(post_data.keys())):
@@ -120,7 +209,7 @@ class RouteController:
                 # this is really post data that was mixed in.
                 del qs_params[k]
 
-        req = {
+        return {
             "path": self.path,
             "method": method,
             "qs_params": qs_params,
@@ -128,16 +217,94 @@ class RouteController:
             "ident": self.ident
         }
 
+
+    def __handler(self, method, qs_params ):
+        # see if there is post data.
+        try:
+            post_data = cherrypy.request.body.params
+        except:
+            post_data = {}
+
+        start = time.time()
+        # the HTTP method of the request, see CHANGES.txt
+        method = cherrypy.request.method
+        req = self._request( method, qs_params, post_data )
+        inm = cherrypy.request.headers.get('If-None-Match',None)
+        ims = cherrypy.request.headers.get('If-Modified-Since',None)
+
+        key = self._cache_key( req )
+        hit = self._lookup( key, inm, ims )
+        if hit:
+            jsmetrics.recordRequest( self.path, method, hit[0], start,
+                done=time.time() )
+            return self._send_reply( *hit )
+
         # checkout a javascript sub process from the pool
         # to use.
         jsh, idx = JsPool.checkout()
-        if 'stream' in self.options and self.options['stream']:
+        checked_out = time.time()
+        if self.options.get('stream',False) == 'push':
+            return self.push_generator(jsh,idx,req,self.options)
+        elif 'stream' in self.options and self.options['stream']:
             return self.generator(jsh,idx,req,self.options)
         else:
             # not-streaming, ajax request or a dynamic web page.
-            res = jsh.transaction(req)
-            JsPool.checkin(jsh, idx)
-            return self._process_response(res)
+            self._conditional( req, inm )
+            self._sample( req )
+            try:
+                res = jsh.transaction(req)
+            except jshandler.RequestTimeout, e:
+                self._record( req, 504, start, checked_out, time.time(), {} )
+                raise cherrypy.HTTPError(504, str(e))
+            except:
+                # the callback threw, counted like the async server does
+                self._record( req, 500, start, checked_out, time.time(), {} )
+                raise
+            finally:
+                JsPool.checkin(jsh, idx)
+            replied = time.time()
+            status = 500
+            size = None
+            try:
+                reply = self._reply(key, res, inm, ims, cherrypy.session)
+                (status, size) = (reply[0], len(reply[2] or ''))
+                return self._send_reply( *reply )
+            except cherrypy.HTTPError, e:
+                status = e.code
+                raise
+            finally:
+                self._record( req, status, start, checked_out, replied, res,
+                    size )
+
+    def _sample(self, req):
+        "mark a request for tracing"
+        if jstrace.Default and jstrace.Default.sample():
+            req['trace'] = True
+
+    def _record(self, req, status, start, checked_out, replied, res,
+      size=None):
+        """
+        metrics, trace spans and traffic log of a request answered by a
+        javascript process
+        """
+        done = time.time()
+        method = req['method']
+        js_time = res.pop('_js_time',None)
+        jsmetrics.recordRequest( self.path, method, status, start,
+            checked_out, replied, js_time, done )
+        trace = res.pop('_trace',None)
+        if trace and jstrace.Default:
+            jstrace.Default.record( self.path, method, start, checked_out,
+                replied, done, trace )
+        if jsreplay.Default:
+            jsreplay.Default.record( req, status, start, done, js_time, size )
+
+    def _send_reply(self, status, headers, data):
+        (headers, data) = self._encode( status, headers, data,
+            cherrypy.request.headers.get('Accept-Encoding',None) )
+        cherrypy.response.status = status
+        cherrypy.response.headers.update( headers )
+        return data
 
     __handler._cp_config = {'response.stream': True} 
 
@@ -177,17 +344,76 @@ class RouteRegistry:
     def __init__(self, api):
         self.api = api
         self.dispatch = cherrypy.dispatch.RoutesDispatcher()
+        self.controllers = []
+
+    def start_processes(self, cache_size, **options):
+        global JsPool
+
+        JsPool.setup( self.api, cache_size, **options )
+
+    def register_metrics(self, path):
+        "serve the metrics page on path"
+        self.dispatch.connect( name=path, route=path,
+            controller=jsmetrics.MetricsController() )
+        jsmetrics.Registry.addCollector( self._collect )
 
-    def start_processes(self, cache_size):
+    def _collect(self):
+        "pool, memory, cache and compression counters for the metrics page"
         global JsPool
 
-        JsPool.setup( self.api, cache_size )
+        s = JsPool.stats()
+        metrics = []
+        for (name, kind, key) in (
+          ('pool_size', 'gauge', 'size'),
+          ('pool_busy', 'gauge', 'busy'),
+          ('pool_idle', 'gauge', 'idle'),
+          ('pool_dead', 'gauge', 'dead'),
+          ('pool_inflight', 'gauge', 'inflight'),
+          ('pool_waiting', 'gauge', 'waiting'),
+          ('pool_overflow_total', 'counter', 'overflow'),
+          ('pool_respawned_total', 'counter', 'respawned'),
+          ('pool_recycled_total', 'counter', 'recycled'),
+          ('pool_timeouts_total', 'counter', 'timeouts'),
+          ('pool_scale_up_total', 'counter', 'scale_up'),
+          ('pool_scale_down_total', 'counter', 'scale_down')):
+            metrics.append( (name, kind, "js process pool %s" % key,
+                [((), s[key])]) )
+
+        memory = jsmemory.report( JsPool.pids() ).items()
+        for key in ('rss', 'pss', 'shared', 'private'):
+            metrics.append( ('worker_memory_%s_bytes' % key, 'gauge',
+                "js process %s memory" % key,
+                [((('pid',pid),), u[key]) for (pid,u) in memory]) )
+
+        caches = self.cache_stats()
+        for key in ('hits', 'misses', 'evictions'):
+            metrics.append( ('cache_%s_total' % key, 'counter',
+                "response cache %s" % key,
+                [((('route',path),), c[key]) for (path,c) in caches.items()]) )
+        metrics.append( ('cache_bytes', 'gauge', "response cache size",
+            [((('route',path),), c['bytes']) for (path,c) in caches.items()]) )
+
+        if jscompress.Default:
+            c = jscompress.Default.stats()
+            for key in ('bytes_in', 'bytes_out', 'hits', 'misses'):
+                metrics.append( ('compress_%s_total' % key, 'counter',
+                    "response compression %s" % key, [((), c[key])]) )
+        return metrics
+
+    def cache_stats(self):
+        "response cache counters of every route with a cache"
+        return dict([(c.path, c.cache.stats()) \
+            for c in self.controllers if c.cache is not None])
 
 
     def register(self, path, jscb, options ):
         opt = dict(options)
+        if opt.get('timeout',None) is not None:
+            # seconds, enforced by the supervisor of the js pool
+            opt['timeout'] = float(opt['timeout'])
         ident = jshandler.AddJsCb( path, jscb, opt )
         control = RouteController( path, ident, opt )
+        self.controllers.append( control )
 
         # are we filtering for a particular url method ?
         method = opt.get('method',None)
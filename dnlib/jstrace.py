@@ -0,0 +1,134 @@
+"""
+Sampled request tracing across the parent and the javascript process. A
+traced request carries 'trace' to the child, which times its own stages
+and returns them with the result; the parent adds its stages and writes
+all of them as Chrome trace events ("X" complete events in the JSON array
+format) that chrome://tracing or Perfetto can open.
+
+    api.settings({'trace': {'path': '/tmp/dn-trace.json', 'sample': 0.01}})
+
+Spans written for each traced request:
+
+    parent   request, checkout, send, reply, response
+    child    receive, version, js call, result conversion,
+             log (every message handed to the route logger)
+
+The file is appended to and never closed with ']', which the trace viewers
+accept, so a crashed server still leaves a readable trace. Writing stops
+once the file reaches 'max_bytes'.
+"""
+import os
+import json
+import random
+import threading
+
+
+DEFAULT_SAMPLE = 0.01
+DEFAULT_MAX_BYTES = 64 * 1024 * 1024
+
+# global tracer set up from the 'trace' setting
+Default = None
+
+
+def _event(name, pid, tid, start, end, args=None):
+    e = {
+        'name': name,
+        'cat': 'dn',
+        'ph': 'X',
+        'ts': int(start * 1e6),
+        'dur': max(0, int((end - start) * 1e6)),
+        'pid': pid,
+        'tid': tid
+    }
+    if args:
+        e['args'] = args
+    return e
+
+
+class Tracer(object):
+    "writes the spans of a sample of the requests to a trace file"
+    def __init__(self, path, sample=DEFAULT_SAMPLE, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.sample_rate = float(sample)
+        self.max_bytes = int(max_bytes)
+        self.lock = threading.Lock()
+        self.f = None
+        self.written = 0
+        self.traced = 0
+
+    def sample(self):
+        "True if the next request should be traced"
+        return self.written < self.max_bytes and \
+            random.random() < self.sample_rate
+
+    def record(self, path, method, start, checked_out, replied, done, trace):
+        """
+        Write the spans of one request. 'trace' is the '_trace' field of
+        the child's result (None when the child could not be traced), the
+        timestamps are time.time() values taken in the parent.
+        """
+        pid = os.getpid()
+        tid = threading.current_thread().ident or 0
+        args = {'route': path, 'method': method}
+        events = [
+            _event('request %s' % path, pid, tid, start, done, args),
+            _event('checkout', pid, tid, start, checked_out)
+        ]
+        if trace:
+            args['rid'] = trace.get('rid')
+            args['child'] = trace['pid']
+            (sent, received) = (trace.get('send'), trace.get('received'))
+            if sent:
+                events.append( _event('send', pid, tid, sent[0], sent[1]) )
+            for (name, s, e) in trace['spans']:
+                events.append( _event(name, trace['pid'], trace['pid'], s, e,
+                    {'route': path}) )
+            if received:
+                events.append( _event('reply', pid, tid, trace['sent'], received) )
+        events.append( _event('response', pid, tid, replied, done) )
+        self._write(events)
+
+    def _write(self, events):
+        data = ''.join([json.dumps(e) + ',\n' for e in events])
+        self.lock.acquire()
+        try:
+            if self.written >= self.max_bytes:
+                return
+            if self.f is None:
+                self.f = open(self.path, 'a')
+                if self.f.tell() == 0:
+                    self.f.write('[\n')
+                self.written = self.f.tell()
+            self.f.write(data)
+            self.f.flush()
+            self.written += len(data)
+            self.traced += 1
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            if self.f:
+                self.f.close()
+                self.f = None
+        finally:
+            self.lock.release()
+
+
+def fromOptions(options):
+    "build a Tracer from the 'trace' setting, None if tracing is off"
+    if not options:
+        return None
+    if options is True:
+        options = {}
+    opt = dict(options)
+    return Tracer(opt.get('path', '/tmp/dn-trace.json'),
+        opt.get('sample', DEFAULT_SAMPLE),
+        opt.get('max_bytes', DEFAULT_MAX_BYTES))
+
+
+def configure(options):
+    "set up the global tracer from the 'trace' setting"
+    global Default
+    Default = fromOptions(options)
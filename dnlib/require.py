@@ -12,7 +12,7 @@ import urlparse
 import os
 import PyInline
 import traceback
-import PyV8
+import jsengine
 import jsapi
 
 
@@ -157,7 +157,7 @@ def _require_c( filename, options ):
                 os.environ['GCC_INCLUDE_DIR'] = ':'.join(includes)
             else:
                 os.environ['GCC_INCLUDE_DIR'] = ';'.join(includes)
-        mod = PyV8.JSClass()
+        mod = jsengine.JSClass()
         data = _file_data( filename )
         if data:
             
@@ -241,7 +241,7 @@ def _require_js( filename, options ):
         # like this: fubar.foo
 
         # local context used as a sandbox for evaluating modules.
-        with PyV8.JSContext( jsapi.HandlerAPI() ) as context:
+        with jsengine.current().createContext( jsapi.HandlerAPI() ) as context:
             # inject 'module' object into javascript.
             context.locals.module = {
                 'exports': {},
@@ -255,13 +255,13 @@ def _require_js( filename, options ):
             
             try:
                 # execute javascript code in module. 
-                context.eval( data )
+                jsengine.current().eval( context, data )
             except:
                 et, ev, e_tb = sys.exc_info()
                 msg = "[%s]\n\t %s" % ( pathname, ev )
                 raise RequireError, msg
 
-            mod = PyV8.JSClass()
+            mod = jsengine.JSClass()
             if len(context.locals.module.exports) > 0:
                 for (n,v) in dict(context.locals.module.exports).items():
                     setattr(mod,n,v)
@@ -281,7 +281,7 @@ def _require_js( filename, options ):
 
 
 def unittest():
-    options =  PyV8.JSClass()
+    options =  jsengine.JSClass()
 
     """
     try:
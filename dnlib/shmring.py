@@ -0,0 +1,145 @@
+"""
+Shared memory transport between cherrypy and the javascript child
+processes. Each direction is a ring buffer living in an anonymous shared
+mapping created before the fork, only a one byte doorbell travels through
+the pipe so the payload is copied once instead of passing through the
+kernel twice. That only pays off for large messages, small ones are faster
+through the pipe and those that do not fit the ring (4 MB by default) go
+through it anyway, see bench/ipc_bench.py.
+"""
+import os
+import mmap
+import struct
+import wirecodec
+from wirecodec import FRAME, read_exact, write_all
+
+
+# default size of each ring buffer in bytes
+DEFAULT_RING_SIZE = 4 * 1024 * 1024
+
+# doorbell codes written into the pipe
+RING_DOORBELL = 'R'    # message is waiting in the ring buffer
+PIPE_DOORBELL = 'P'    # message did not fit, it follows inline in the pipe
+
+
+class ShmRing(object):
+    """ Single producer, single consumer byte ring. The header holds two
+        monotonic byte counters (head = bytes written, tail = bytes read)
+        the producer only moves head and the consumer only moves tail.
+    """
+    HEADER = struct.Struct('>QQ')
+
+    def __init__(self, size=DEFAULT_RING_SIZE):
+        self.size = size
+        self.base = self.HEADER.size
+        # anonymous mappings are MAP_SHARED so both sides of a fork see them
+        self.mem = mmap.mmap(-1, self.base + size)
+
+    def _counters(self):
+        return self.HEADER.unpack(self.mem[0:self.base])
+
+    def free(self):
+        head, tail = self._counters()
+        return self.size - (head - tail)
+
+    def put(self, parts):
+        """ Copy a list of strings into the ring as one unit, the head counter
+            is published once all parts are in place. Returns False if there
+            is not enough room.
+        """
+        total = sum([len(p) for p in parts])
+        head, tail = self._counters()
+        if total > self.size - (head - tail):
+            return False
+
+        pos = head
+        for data in parts:
+            off = pos % self.size
+            first = min(len(data), self.size - off)
+            if first == len(data):
+                self.mem[self.base+off:self.base+off+first] = data
+            else:
+                # wrap around the end of the ring
+                rest = len(data) - first
+                self.mem[self.base+off:self.base+off+first] = data[:first]
+                self.mem[self.base:self.base+rest] = data[first:]
+            pos += len(data)
+
+        self.mem[0:8] = struct.pack('>Q', pos)
+        return True
+
+    def get(self, n):
+        "Copy n bytes out of the ring and release the space"
+        head, tail = self._counters()
+        if n > head - tail:
+            raise EOFError, "ring buffer underrun"
+        off = tail % self.size
+        first = min(n, self.size - off)
+        data = self.mem[self.base+off:self.base+off+first]
+        if first < n:
+            data += self.mem[self.base:self.base+(n-first)]
+        self.mem[8:16] = struct.pack('>Q', tail + n)
+        return data
+
+
+
+class ShmChannel(object):
+    """ Drop in replacement for IOChannel, objects are serialized into a
+        shared memory ring and a doorbell byte is sent through a pipe so
+        the other side can still use poll() to wait for it. Messages larger
+        than the free space of the ring go through the pipe inline.
+    """
+    def __init__(self, codec=wirecodec.DEFAULT_CODEC, size=DEFAULT_RING_SIZE):
+        self.r, self.w = os.pipe()
+        self.ring = ShmRing(size)
+        self.codec = wirecodec.getCodec(codec)
+
+    def fileno(self):
+        return self.r
+
+    def recv(self):
+        "un-serialize an incoming object"
+        bell = read_exact(self.r, 1)
+        if bell == RING_DOORBELL:
+            size = FRAME.unpack(self.ring.get(FRAME.size))[0]
+            data = self.ring.get(size)
+        else:
+            size = FRAME.unpack(read_exact(self.r, FRAME.size))[0]
+            data = read_exact(self.r, size)
+        return self.codec.decode(data)
+
+    def send(self, obj):
+        "serialize and send an object"
+        data = self.codec.encode(obj)
+        hdr = FRAME.pack(len(data))
+        if self.ring.put([hdr, data]):
+            os.write(self.w, RING_DOORBELL)
+        else:
+            write_all(self.w, PIPE_DOORBELL + hdr)
+            write_all(self.w, data)
+
+    def fds(self):
+        "file descriptors still open"
+        return [fd for fd in (self.r, self.w) if fd is not None]
+
+    def close_read(self):
+        if self.r is not None:
+            _close_fd(self.r)
+            self.r = None
+
+    def close_write(self):
+        if self.w is not None:
+            _close_fd(self.w)
+            self.w = None
+
+    def close(self):
+        self.close_read()
+        self.close_write()
+        self.ring.mem.close()
+
+
+def _close_fd(fd):
+    try:
+        os.close(fd)
+    except OSError:
+        pass
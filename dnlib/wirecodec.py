@@ -0,0 +1,186 @@
+"""
+Wire codecs used to serialize objects exchanged between cherrypy and the
+javascript child processes. Every message is framed with a 4 byte length
+prefix so it can be read with exactly two reads, the codec used for the
+body is picked when the process pool is set up.
+"""
+import os
+import struct
+import marshal
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+
+# length prefix of every message
+FRAME = struct.Struct('>I')
+
+# marshal format version, 2 is the newest python 2.x understands
+MARSHAL_VERSION = 2
+
+# first byte of every pickle protocol 2 stream
+PICKLE_PROTO = '\x80'
+
+# name of the codec used when none is configured
+DEFAULT_CODEC = 'binary'
+
+
+def read_exact(fd, n):
+    "read exactly n bytes from a file descriptor"
+    chunks = []
+    while n > 0:
+        data = os.read(fd, n)
+        if not data:
+            raise EOFError, "pipe closed"
+        chunks.append(data)
+        n -= len(data)
+    return ''.join(chunks)
+
+
+def write_all(fd, data):
+    "write all of data to a file descriptor"
+    view = buffer(data)
+    while len(view) > 0:
+        n = os.write(fd, view)
+        view = buffer(view, n)
+
+
+class PickleCodec(object):
+    "pickle protocol 2, handles any picklable object"
+    name = 'pickle'
+
+    def encode(self, obj):
+        return pickle.dumps(obj, 2)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+class MarshalCodec(object):
+    """ marshal, much faster than pickle. Objects marshal can not handle are
+        sent as a pickle, told apart by the protocol 2 opcode it starts with
+        since no marshal stream begins with it.
+    """
+    name = 'marshal'
+
+    def encode(self, obj):
+        try:
+            return marshal.dumps(obj, MARSHAL_VERSION)
+        except ValueError:
+            # not a builtin type somewhere inside the object
+            return pickle.dumps(obj, 2)
+
+    def decode(self, data):
+        if data[0] == PICKLE_PROTO:
+            return pickle.loads(data)
+        return marshal.loads(data)
+
+
+class BinaryCodec(object):
+    """ Compact tagged format. Bodies are a marshaled tuple whose first item
+        is a tag saying how the rest is laid out:
+
+          'Q'  a request dict, the fixed fields follow in a known order so
+               their key names never go over the wire
+          'M'  any other object marshal can handle
+
+        Objects marshal can not handle, or messages carrying a large body
+        which marshal copies slowly, are sent as a pickle instead. A pickle
+        is told apart by the protocol 2 opcode it starts with.
+    """
+    name = 'binary'
+
+    REQUEST_FIELDS = ('path', 'method', 'ident', 'qs_params', 'post_data')
+
+    # bodies above this size go through pickle
+    LARGE_VALUE = 0x8000
+
+    def _is_large(self, v):
+        t = type(v)
+        if t == str or t == unicode:
+            return len(v) > self.LARGE_VALUE
+        elif t == dict:
+            for x in v.itervalues():
+                if (type(x) == str or type(x) == unicode) and \
+                  len(x) > self.LARGE_VALUE:
+                    return True
+        return False
+
+    def _encode_request(self, obj):
+        if self._is_large(obj['post_data']):
+            return pickle.dumps(obj, 2)
+
+        extras = None
+        if len(obj) != len(self.REQUEST_FIELDS):
+            extras = dict(obj)
+            for k in self.REQUEST_FIELDS:
+                del extras[k]
+        return marshal.dumps(('Q', obj['path'], obj['method'], obj['ident'],
+            obj['qs_params'], obj['post_data'], extras), MARSHAL_VERSION)
+
+    def encode(self, obj):
+        try:
+            if type(obj) == dict:
+                if 'ident' in obj and 'post_data' in obj and 'path' in obj \
+                  and 'method' in obj and 'qs_params' in obj:
+                    return self._encode_request(obj)
+                elif self._is_large(obj.get('data')) or \
+                  self._is_large(obj.get('chunk')):
+                    # response or stream chunk carrying a big body
+                    return pickle.dumps(obj, 2)
+            return marshal.dumps(('M', obj), MARSHAL_VERSION)
+        except ValueError:
+            # not a builtin type somewhere inside the object
+            return pickle.dumps(obj, 2)
+
+    def decode(self, data):
+        if data[0] == PICKLE_PROTO:
+            return pickle.loads(data)
+
+        msg = marshal.loads(data)
+        if msg[0] == 'Q':
+            (tag, path, method, ident, qs_params, post_data, obj) = msg
+            if obj is None:
+                obj = {}
+            obj['path'] = path
+            obj['method'] = method
+            obj['ident'] = ident
+            obj['qs_params'] = qs_params
+            obj['post_data'] = post_data
+            return obj
+        elif msg[0] == 'M':
+            return msg[1]
+        raise ValueError, "unknown wire codec tag %r" % msg[0]
+
+
+Codecs = {
+    'pickle' : PickleCodec(),
+    'marshal': MarshalCodec(),
+    'binary' : BinaryCodec()
+}
+
+
+def getCodec(name):
+    if name not in Codecs:
+        raise ValueError, \
+            "codec must be one of %s" % ",".join(sorted(Codecs.keys()))
+    return Codecs[name]
+
+
+def send_frame(fd, codec, obj):
+    "serialize obj with codec and write it as one length prefixed frame"
+    data = codec.encode(obj)
+    hdr = FRAME.pack(len(data))
+    if len(data) < 0x10000:
+        write_all(fd, hdr + data)
+    else:
+        # avoid copying large bodies just to prepend the header
+        write_all(fd, hdr)
+        write_all(fd, data)
+
+
+def recv_frame(fd, codec):
+    "read one length prefixed frame and un-serialize it"
+    size = FRAME.unpack(read_exact(fd, FRAME.size))[0]
+    return codec.decode(read_exact(fd, size))
@@ -1,6 +1,6 @@
-import PyV8
 import sys
 from dnlib.jsapi import RootAPI
+from dnlib import jsengine
 import os
 import readline
 
@@ -17,11 +17,11 @@ Version = "0.1"
 
 class Shell(object):
     def __init__(self):
-        self.ctxt = PyV8.JSContext( RootAPI() )
+        self.ctxt = jsengine.current().createContext( RootAPI() )
         self.ctxt.enter()
 
     def evaluate(self, line):
-        return self.ctxt.eval( line )
+        return jsengine.current().eval( self.ctxt, line )
         
     def __del__(self):
         self.ctxt.leave()  
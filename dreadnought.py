@@ -1,9 +1,11 @@
 #!/usr/bin/env python
 
 from dnlib import jsapi
+from dnlib import jsengine
 import dnshell
 import argparse
 import logging
+import sys
 
 DnDescription = \
 """
@@ -13,7 +15,51 @@ the 1000's of mature libraries written in Python and C over the decades in
 a seamless fashion.
 """
 
+def replay_args(argv):
+    "options of 'dn replay LOG SCRIPT'"
+    parser = argparse.ArgumentParser(
+        prog="dn replay",
+        description="Replay a traffic log recorded with the 'record' setting "
+            "against a fresh javascript process pool"
+    )
+    parser.add_argument("log", help="traffic log to replay")
+    parser.add_argument("script", help="script registering the routes")
+    parser.add_argument("--speed", type=float, default=1.0,
+        help="speed up factor, 0 sends the requests as fast as possible")
+    parser.add_argument("--threads", type=int, default=64,
+        help="requests in flight at most, default 64")
+    parser.add_argument("--json", metavar="FILE",
+        help="also write the latency distributions to FILE")
+    parser.add_argument("--engine", choices=sorted(jsengine.Engines.keys()),
+        help="javascript engine, default pyv8")
+    parser.add_argument("--loglevel", default="WARN")
+    parser.add_argument("--logfile", default="/dev/stdout")
+    for name in ('js_pool', 'js_pipeline', 'js_queue_max', 'js_overflow_spares'):
+        parser.add_argument("--" + name.replace('_', '-'), dest=name, type=int)
+    for name in ('ipc', 'codec'):
+        parser.add_argument("--" + name, dest=name)
+
+    args = vars(parser.parse_args(argv))
+    settings = dict([(k, v) for (k, v) in args.items() \
+        if k.startswith('js_') or k in ('ipc', 'codec')])
+    args['replay'] = {
+        'log': args['log'],
+        'speed': args['speed'],
+        'threads': args['threads'],
+        'json': args['json'],
+        'settings': dict([(k, v) for (k, v) in settings.items() if v is not None])
+    }
+    return args
+
+
 if __name__ == '__main__':
+    if sys.argv[1:2] == ['replay']:
+        args = replay_args(sys.argv[2:])
+        if args['engine']:
+            jsengine.select( args['engine'] )
+        jsapi.run( args['script'], args )
+        sys.exit(0)
+
     parser = argparse.ArgumentParser(
         description=DnDescription,
         epilog="Version %s" % jsapi.Version 
@@ -27,6 +73,22 @@ if __name__ == '__main__':
         default="DEBUG"
     )
 
+    parser.add_argument("--engine",
+        choices=sorted(jsengine.Engines.keys()),
+        help="javascript engine, default pyv8",
+        default=None
+    )
+    parser.add_argument("--profile",
+        metavar="DIR",
+        help="sample the javascript processes, folded stacks are written to DIR",
+        default=None
+    )
+    parser.add_argument("--profile-interval",
+        type=float,
+        help="seconds of CPU time between samples, default 0.01",
+        default=None
+    )
+
     parser.add_argument("execute", 
         nargs="*",
         help="file to be executed, if not provided then it invokes an interactive shell",
@@ -36,6 +98,8 @@ if __name__ == '__main__':
 
 
     args = vars(parser.parse_args())
+    if args['engine']:
+        jsengine.select( args['engine'] )
     if args['execute']:
         jsapi.run( args['execute'][0], args )
     else: 